@@ -0,0 +1,7 @@
+"""
+Benchmarks of noweb.py.
+
+Run them all with ``python -m benchmarks``, see ``benchmarks/suite.py``. The
+other modules time single parts in more detail, against the implementations
+they replaced.
+"""
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+"""
+Generates synthetic literate documents for the benchmarks.
+"""
+
+from __future__ import unicode_literals
+
+
+
+def tree_size(fanout, depth):
+    """Return the number of chunks in a tree of the given shape."""
+    return sum(fanout ** level for level in range(depth + 1))
+
+
+def generate(chunks=20000, code_lines=10, prose_lines=8, fanout=2, depth=4):
+    """Return a document, as bytes, with about the given number of chunks.
+
+    The chunks form trees: the root of every tree is a module named
+    module_N.py, every other chunk is a function that references fanout
+    chunks of the next level, down to depth levels below the root. The
+    tangled modules are valid Python, so they can be imported too.
+    """
+    size = tree_size(fanout, depth)
+    out = ["<!--- literate: syntax=markdown encoding=utf-8 -->\n"]
+    for tree in range((chunks + size - 1) // size):
+        first = tree * size
+
+        def children(node):
+            start = node * fanout + 1
+            return [first + child
+                for child in range(start, min(start + fanout, size))]
+
+        out.append("# Module %d\n\n" % (tree,))
+        out.append("\n<<python:module_%d.py>>=\n" % (tree,))
+        out.append("decorate = lambda function: function\n")
+        out.extend("<<chunk %d>>\n" % (child,) for child in children(0))
+        out.append("@\n\n")
+        for node in range(1, size):
+            i = first + node
+            out.append("## Section %d\n\n" % (i,))
+            out.extend("Some prose about section %d, line %d, with `code`.\n"
+                % (i, j) for j in range(prose_lines))
+            out.append("\n<<python:chunk %d>>=\n" % (i,))
+            out.append("@@ decorate\n")
+            out.append("def function_%d(value):\n" % (i,))
+            out.extend("    value = value * %d + %d  # << shift\n" % (j, i)
+                for j in range(code_lines))
+            out.extend("    <<chunk %d>>\n" % (child,)
+                for child in children(node))
+            out.append("    return value\n")
+            out.append("@ trailing documentation\n\n")
+    return "".join(out).encode('utf-8')
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Times Reader.edit on a large generated document, changing a line of code in
+place and inserting one in the code or in the documentation, and compares it
+with reading the whole document again. Both must give the same chunks.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import noweb
+from benchmarks.documents import generate
+
+
+
+def code_line(doc):
+    """Return the position of a line of code in the middle of doc."""
+    names = [name for name in doc.chunks if name is not None
+        and doc.chunks[name].lines]
+    names.sort(key=lambda name: doc.chunks[name].position)
+    return doc.chunks[names[len(names) // 2]].lines[0].position
+
+
+def prose_line(doc):
+    """Return the position of a line of documentation in the middle of doc."""
+    lines = doc.chunks[None].lines
+    index = len(lines) // 2
+    while lines[index].type != noweb.Line.DOCUMENTATION:
+        index += 1
+    return lines[index].position
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sections', type=int, default=20000,
+        help='documented chunks in the document (default: %(default)s)')
+    parser.add_argument('-n', '--number', type=int, default=10,
+        help='edits per measurement (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='measurements, the best one is reported (default: %(default)s)')
+    args = parser.parse_args()
+
+    data = generate(args.sections)
+    doc = noweb.Reader(editable=True)
+    doc.read(io.BytesIO(data))
+    position = code_line(doc)
+    prose = prose_line(doc)
+
+    def read():
+        noweb.Reader().read(io.BytesIO(data))
+
+    def replace():
+        doc.edit(position, position + 1, "    x = 42\n")
+
+    def insert():
+        doc.edit(position, position, "    x = 42\n")
+        doc.edit(position, position + 1, "")
+
+    def insert_prose():
+        doc.edit(prose, prose, "More about it.\n")
+        doc.edit(prose, prose + 1, "")
+
+    print("%.1f MB, %d lines" % (len(data) / 1e6, data.count(b'\n')))
+    for name, func, number in [
+            ("Reader.read", read, 1),
+            ("replace a line", replace, args.number),
+            ("insert, remove", insert, args.number),
+            ("same in prose", insert_prose, args.number)]:
+        best = min(timeit.repeat(func, number=number,
+            repeat=args.repeat)) / number
+        print("%-16s %8.3f ms" % (name, best * 1000))
+
+    text = io.BytesIO(data).read().decode('utf-8').splitlines(True)
+    text[position - 1] = "    x = 42\n"
+    expected = noweb.Reader()
+    expected.read(io.StringIO("".join(text)))
+    if doc.chunks != expected.chunks:
+        sys.exit("Editing and reading again disagree on the chunks")
+
+
+if __name__ == '__main__':
+    main()
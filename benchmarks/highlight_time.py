@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Times weaving a generated document to HTML plainly, highlighted with Pygments,
+and highlighted with a cache of the rendered chunks: empty, full, and after a
+chunk changed. The cached documents must be the same as the others.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import noweb
+from benchmarks.documents import generate
+
+
+
+def read(data):
+    doc = noweb.Reader()
+    doc.read(io.BytesIO(data))
+    return doc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sections', type=int, default=2000,
+        help='documented chunks in the document (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='measurements, the best one is reported (default: %(default)s)')
+    args = parser.parse_args()
+    try:
+        import pygments
+    except ImportError:
+        sys.exit("Highlighting needs Pygments")
+
+    data = generate(args.sections)
+    changed = data.replace(b"def function_1(", b"def function_one(")
+    doc = read(data)
+    directory = tempfile.mkdtemp()
+    cache = os.path.join(directory, 'cache')
+
+    def weave(doc, **kwargs):
+        return doc.write(doc.weave(format='html', add_links=True, **kwargs))
+
+    def cold():
+        shutil.rmtree(cache, ignore_errors=True)
+        return weave(doc, highlight=True, cache=cache)
+
+    def edited():
+        # Only the changed chunk is missing from the cache
+        cold()
+        new = read(changed)
+        start = timeit.default_timer()
+        weave(new, highlight=True, cache=cache)
+        return timeit.default_timer() - start
+
+    try:
+        print("%.1f MB, %d chunks, Pygments %s" % (len(data) / 1e6,
+            len(doc.chunks) - 1, pygments.__version__))
+        for name, func in [
+                ("plain", lambda: weave(doc)),
+                ("highlighted", lambda: weave(doc, highlight=True)),
+                ("empty cache", cold),
+                ("full cache", lambda: weave(doc, highlight=True,
+                    cache=cache))]:
+            best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+            print("%-16s %8.1f ms" % (name, best * 1000))
+        best = min(edited() for i in range(args.repeat))
+        print("%-16s %8.1f ms" % ("a chunk changed", best * 1000))
+
+        if weave(doc, highlight=True) != weave(doc, highlight=True,
+                cache=cache):
+            sys.exit("The cached document differs")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
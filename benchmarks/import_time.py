@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Times how long ImportHook takes to turn noweb.py.nw into a code object, and
+compares the in-place line-number remapping with the copying NodeTransformer
+it replaced.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import ast
+import copy
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import noweb
+
+
+
+class CopyingRewriteLine(ast.NodeTransformer):
+    """The line-number re-writer used before the in-place one."""
+
+    def __init__(self, line_map):
+        self.line_map = line_map
+
+    def visit(self, node):
+        try:
+            node = copy.copy(node)
+            node.lineno = self.line_map[node.lineno]
+            if getattr(node, 'end_lineno', None) is not None:
+                node.end_lineno = max(node.lineno,
+                    self.line_map.get(node.end_lineno, node.lineno))
+        except (AttributeError, KeyError):
+            pass
+        return super(CopyingRewriteLine, self).visit(node)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('input', metavar='FILE', nargs='?',
+        default=os.path.join(ROOT, 'noweb.py.nw'),
+        help='literate module to compile (default: %(default)s)')
+    parser.add_argument('-R', '--chunk', metavar='CHUNK', default='noweb.py',
+        help='chunk holding the module (default: %(default)s)')
+    parser.add_argument('-n', '--number', type=int, default=20,
+        help='runs per measurement (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+        help='measurements, the best one is reported (default: %(default)s)')
+    args = parser.parse_args()
+
+    doc = noweb.Reader(args.input)
+    lines = doc.tangle(args.chunk)
+    source = doc.write(lines)
+    line_map = [0] + [line.position for line in lines]
+    col_shift = [0] + [len(line.indentation) for line in lines]
+    line_dict = dict(enumerate(line_map))
+
+    hook = noweb.ImportHook()
+    hook.cache_bytecode = False
+    info = dict(path=args.input, chunk=args.chunk, ispkg=False)
+
+    def parse():
+        return ast.parse(source, args.input, 'exec')
+
+    def copying():
+        return CopyingRewriteLine(line_dict).visit(parse())
+
+    def in_place():
+        return noweb.RewriteLine(line_map, col_shift).visit(parse())
+
+    def get_code():
+        return hook.get_code(args.chunk, info)
+
+    print("%d tangled lines from %s" % (len(lines), args.input))
+    for name, func in [
+            ("parse only", parse),
+            ("parse + copying remap", copying),
+            ("parse + in-place remap", in_place),
+            ("ImportHook.get_code", get_code)]:
+        best = min(timeit.repeat(func, number=args.number,
+            repeat=args.repeat)) / args.number
+        print("%-24s %8.2f ms" % (name, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
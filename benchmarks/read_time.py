@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Times Reader.read on a large generated document and compares it with the
+regex cascade it replaced. Both readers must produce the same chunks.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import noweb
+from benchmarks.documents import generate
+from noweb import Chunk, Line
+
+
+
+class RegexReader(noweb.Reader):
+    """Reader using the regex cascade of the original implementation."""
+
+    def read(self, input):
+        self.last_fname = None
+        self._expanded = {}
+        self._digests = {}
+        chunkName = None
+
+        for lnum, line in enumerate(input):
+            if isinstance(line, bytes):
+                line = line.decode(self.encoding or 'utf-8')
+            if lnum == 0:
+                match = self.firstline_re.match(line)
+                if match:
+                    options = match.groupdict()
+                    encoding = options["encoding"]
+                    if encoding:
+                        self.encoding = encoding
+                    syntax = options["syntax"]
+                    if syntax:
+                        self.chunks[None] = self.chunks[None]._replace(
+                            syntax=syntax)
+                    continue
+            match = self.chunk_def.match(line)
+            if match and not chunkName:
+                chunkName = match.group('name')
+                chunkSyntax = match.group('syntax')
+                self.chunks[None].lines.append(Line(type=Line.CHUNK_BEGIN,
+                    value=chunkName, indentation="", position=lnum + 1))
+                self.chunks[chunkName] = Chunk(syntax=chunkSyntax, lines=[],
+                    position=lnum + 1)
+            else:
+                match = self.chunk_end.match(line)
+                if match:
+                    chunkName = None
+                    text = match.group('text')
+                    if text:
+                        self.chunks[chunkName].lines.append(Line(
+                            type=Line.DOCUMENTATION,
+                            value=text, indentation="", position=lnum + 1))
+                else:
+                    line = self.chunk_at.sub('@', line)
+                    match = self.chunk_invocation.match(line)
+                    if match:
+                        sub_chunk = match.group('name')
+                        sub_indent = match.group('indent')
+                        self.chunks[chunkName].lines.append(Line(
+                            type=Line.REFERENCE, value=sub_chunk,
+                            indentation=sub_indent, position=lnum + 1))
+                    else:
+                        self.chunks[chunkName].lines.append(Line(
+                            type=Line.CODE if chunkName
+                                else Line.DOCUMENTATION,
+                            value=line, indentation="", position=lnum + 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sections', type=int, default=20000,
+        help='documented chunks in the document (default: %(default)s)')
+    parser.add_argument('-n', '--number', type=int, default=3,
+        help='runs per measurement (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='measurements, the best one is reported (default: %(default)s)')
+    args = parser.parse_args()
+
+    data = generate(args.sections)
+
+    def read(cls):
+        doc = cls()
+        doc.read(io.BytesIO(data))
+        return doc
+
+    if read(RegexReader).chunks != read(noweb.Reader).chunks:
+        sys.exit("The readers disagree on the chunks of the document")
+
+    print("%.1f MB, %d lines" % (len(data) / 1e6, data.count(b'\n')))
+    for name, cls in [
+            ("regex cascade", RegexReader),
+            ("Reader.read", noweb.Reader)]:
+        best = min(timeit.repeat(lambda: read(cls), number=args.number,
+            repeat=args.repeat)) / args.number
+        print("%-16s %8.1f ms" % (name, best * 1000))
+
+
+if __name__ == '__main__':
+    main()
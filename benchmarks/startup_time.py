@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Times how long the noweb.py command line takes to tangle a small document,
+run as a script, as a module and loading itself from noweb.py.nw, and lists
+the modules that importing noweb spends the most time on, according to
+``python -X importtime``.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.documents import generate
+
+
+
+def import_times(python):
+    """Return the self and cumulative microseconds of every module imported
+    by importing noweb, as reported by -X importtime."""
+    try:
+        output = subprocess.check_output([python, '-X', 'importtime', '-c',
+            'import noweb'], cwd=ROOT, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        return {}
+    times = {}
+    for line in output.decode('utf-8').splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3:
+            continue
+        try:
+            own = int(fields[0].split(':')[1])
+            cumulative = int(fields[1])
+        except ValueError:
+            continue
+        times[fields[2].strip()] = (own, cumulative)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--python', default=sys.executable,
+        help='interpreter to run noweb.py with (default: %(default)s)')
+    parser.add_argument('-t', '--top', type=int, default=15,
+        help='modules to list by import time (default: %(default)s)')
+    parser.add_argument('-n', '--number', type=int, default=5,
+        help='runs per measurement (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='measurements, the best one is reported (default: %(default)s)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        document = os.path.join(directory, 'small.nw')
+        with open(document, 'wb') as f:
+            f.write(generate(20))
+        output = os.path.join(directory, 'module_0.py')
+        tangle = ['-o', output, 'tangle', '-R', 'module_0.py', document]
+        script = os.path.join(ROOT, 'noweb.py')
+        self_load = dict(os.environ, NOWEB_SELF_LOAD='1')
+
+        print("%s, tangling %s" % (args.python, os.path.basename(document)))
+        for name, command, env in [
+                ("python -c pass", [args.python, '-c', 'pass'], None),
+                ("noweb.py", [args.python, script] + tangle, None),
+                ("python -m noweb", [args.python, '-m', 'noweb'] + tangle,
+                    None),
+                ("NOWEB_SELF_LOAD=1", [args.python, script] + tangle,
+                    self_load)]:
+            run = lambda: subprocess.check_call(command, cwd=ROOT, env=env)
+            run()
+            best = min(timeit.repeat(run, number=args.number,
+                repeat=args.repeat)) / args.number
+            print("%-20s %8.1f ms" % (name, best * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+    times = import_times(args.python)
+    if 'noweb' not in times:
+        sys.exit("-X importtime needs Python 3.7 or later")
+    print("\nimport noweb: %.1f ms, of which" % (times['noweb'][1] / 1000.0,))
+    print("%10s %10s  %s" % ("self ms", "total ms", "module"))
+    slowest = sorted((item for item in times.items() if item[0] != 'noweb'),
+        key=lambda item: -item[1][1])
+    for name, (own, cumulative) in slowest[:args.top]:
+        print("%10.1f %10.1f  %s" % (own / 1000.0, cumulative / 1000.0, name))
+
+
+if __name__ == '__main__':
+    main()
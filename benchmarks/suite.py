@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Times reading, tangling, weaving, writing and importing a synthetic document
+and noweb.py.nw itself, and measures the memory each of them allocates at its
+peak. The results can be saved as JSON and compared with those of another
+revision.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import noweb
+from benchmarks.documents import generate
+
+OPERATIONS = ["read", "tangle", "weave", "write", "import"]
+
+
+
+class Case(object):
+    """A document, and the operations of noweb.py timed on it."""
+
+    def __init__(self, name, data, module, parameters=None):
+        self.name = name
+        self.data = data
+        self.module = module
+        self.parameters = parameters or {}
+
+    def setup(self, directory):
+        self.path = os.path.join(directory, self.module + '.nw')
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.doc = self.read()
+        self.roots = self.doc.roots()
+        self.lines = [line for name in self.roots
+            for line in self.doc.tangle(name)]
+        self.hook = noweb.ImportHook()
+        self.hook.cache_bytecode = False
+        self.info = dict(path=self.path, chunk=self.module, ispkg=False)
+
+    def read(self):
+        doc = noweb.Reader()
+        doc.read(io.BytesIO(self.data))
+        return doc
+
+    def tangle(self):
+        # Forget what was expanded before, as a new reader would
+        self.doc._expanded = {}
+        return [self.doc.tangle(name) for name in self.roots]
+
+    def weave(self):
+        return list(self.doc.weave(add_links=False))
+
+    def write(self):
+        return self.doc.write(self.lines)
+
+    def import_(self):
+        self.hook.invalidate_caches()
+        return self.hook.get_code(self.module, self.info)
+
+    def operation(self, name):
+        return getattr(self, name + '_' if name == 'import' else name)
+
+
+def peak_memory(func):
+    """Return the peak of the memory allocated while running func."""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+            '--dirty'], cwd=ROOT, stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(cases, operations, number, repeat):
+    results = dict(revision=revision(), python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'), cases={})
+    directory = tempfile.mkdtemp()
+    try:
+        for case in cases:
+            case.setup(directory)
+            timings = {}
+            for name in operations:
+                func = case.operation(name)
+                best = min(timeit.repeat(func, number=number,
+                    repeat=repeat)) / number
+                timings[name] = dict(time=best, memory=peak_memory(func))
+            results['cases'][case.name] = dict(parameters=case.parameters,
+                bytes=len(case.data), lines=case.data.count(b'\n'),
+                results=timings)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def report(results, baseline=None):
+    print("revision %s, %s %s" % (results['revision'],
+        results['implementation'], results['python']))
+    if baseline is not None:
+        print("compared with revision %s, %s %s" % (baseline['revision'],
+            baseline['implementation'], baseline['python']))
+    for name, case in sorted(results['cases'].items()):
+        print("\n%s: %.1f MB, %d lines" % (name, case['bytes'] / 1e6,
+            case['lines']))
+        old = {}
+        if baseline is not None:
+            old = baseline['cases'].get(name, {}).get('results', {})
+        for operation in OPERATIONS:
+            if operation not in case['results']:
+                continue
+            result = case['results'][operation]
+            line = "%-8s %10.2f ms" % (operation, result['time'] * 1000)
+            if result['memory'] is not None:
+                line += " %10.1f MB" % (result['memory'] / 1e6,)
+            if operation in old:
+                line += "   x%.2f time" % (result['time']
+                    / old[operation]['time'],)
+                if result['memory'] and old[operation]['memory']:
+                    line += ", x%.2f memory" % (result['memory']
+                        / old[operation]['memory'],)
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', '--output', metavar='FILE',
+        help='save the results as JSON to this file')
+    parser.add_argument('-c', '--compare', metavar='FILE',
+        help='compare with results saved before')
+    parser.add_argument('--case', choices=['synthetic', 'noweb'],
+        action='append', help='only run this case (default: all)')
+    parser.add_argument('--operation', choices=OPERATIONS, action='append',
+        help='only time this operation (default: all)')
+    parser.add_argument('--chunks', type=int, default=5000,
+        help='chunks in the synthetic document (default: %(default)s)')
+    parser.add_argument('--code-lines', type=int, default=10,
+        help='lines of code per chunk (default: %(default)s)')
+    parser.add_argument('--prose-lines', type=int, default=8,
+        help='lines of prose per chunk (default: %(default)s)')
+    parser.add_argument('--fanout', type=int, default=2,
+        help='chunks referenced by every chunk (default: %(default)s)')
+    parser.add_argument('--depth', type=int, default=4,
+        help='levels of chunks below every root (default: %(default)s)')
+    parser.add_argument('-n', '--number', type=int, default=3,
+        help='runs per measurement (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='measurements, the best one is reported (default: %(default)s)')
+    args = parser.parse_args()
+
+    cases = []
+    if not args.case or 'synthetic' in args.case:
+        parameters = dict(chunks=args.chunks, code_lines=args.code_lines,
+            prose_lines=args.prose_lines, fanout=args.fanout,
+            depth=args.depth)
+        cases.append(Case('synthetic', generate(**parameters),
+            'module_0.py', parameters))
+    if not args.case or 'noweb' in args.case:
+        with open(os.path.join(ROOT, 'noweb.py.nw'), 'rb') as f:
+            cases.append(Case('noweb.py.nw', f.read(), 'noweb.py'))
+
+    results = run(cases, args.operation or OPERATIONS, args.number,
+        args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
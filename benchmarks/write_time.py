@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Times Reader.write on the tangled output of a large generated document and
+compares it with the per-line encoding it replaced. Both must write the same
+bytes.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import io
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import noweb
+from benchmarks.documents import generate
+
+try:
+    basestring
+except NameError:
+    basestring = unicode = str
+
+
+
+class LineWriter(noweb.Reader):
+    """Reader writing its output the way the original implementation did."""
+
+    def write(self, lines, file=None, atomic=False):
+        outfile = io.BytesIO() if file is None or isinstance(file, basestring) \
+            else file
+        for line in lines:
+            outfile.write(unicode(line).encode(self.encoding or 'utf-8'))
+        if file is None:
+            return outfile.getvalue()
+        with open(file, 'wb') as f:
+            f.write(outfile.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sections', type=int, default=20000,
+        help='documented chunks in the document (default: %(default)s)')
+    parser.add_argument('-n', '--number', type=int, default=3,
+        help='runs per measurement (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='measurements, the best one is reported (default: %(default)s)')
+    args = parser.parse_args()
+
+    doc = noweb.Reader()
+    doc.read(io.BytesIO(generate(args.sections)))
+    # The code of every chunk, so that the output is as big as the document
+    lines = [line for name in doc.chunks if name is not None
+        for line in doc.chunks[name].lines if line.type == noweb.Line.CODE]
+    old = LineWriter()
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'out.py')
+        if old.write(lines) != doc.write(lines):
+            sys.exit("The writers disagree on the output")
+
+        print("%d lines, %.1f MB" % (len(lines), len(doc.write(lines)) / 1e6))
+        for name, func in [
+                ("per line, to file", lambda: old.write(lines, path)),
+                ("batched, to bytes", lambda: doc.write(lines)),
+                ("batched, to file", lambda: doc.write(lines, path)),
+                ("batched, atomic", lambda: doc.write(lines, path, True))]:
+            best = min(timeit.repeat(func, number=args.number,
+                repeat=args.repeat)) / args.number
+            print("%-20s %8.1f ms" % (name, best * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
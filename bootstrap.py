@@ -8,6 +8,7 @@
 
 import re
 import codecs
+import types
 
 
 
@@ -30,7 +31,7 @@ def read(infile, encoding):
                 chunkName = match.group(1)
                 chunks[chunkName] = []
             else:
-                match = re.match("@", line)
+                match = re.match(r"@(?:\s|$)", line)
                 if match:
                     chunkName = None
                 elif chunkName:
@@ -47,11 +48,11 @@ def tangle(chunkName, chunks, indent):
     chunkLines = chunks[chunkName]
     expandedChunkLines = []
     for line in chunkLines:
-        match = re.match("(\s*)" + OPEN + CHUNK + CLOSE + "\s*$", line)
+        match = re.match(r"(\s*)" + OPEN + CHUNK + CLOSE + r"\s*$", line)
         if match:
             expandedChunkLines.extend(tangle(match.group(2), chunks, indent + match.group(1)))
         else:
-            expandedChunkLines.append(indent + line)
+            expandedChunkLines.append(line if line in ("\n", "\r\n") else indent + line)
     return expandedChunkLines
 
 
@@ -66,6 +67,26 @@ def write(lines, chunkName, output, encoding):
             f.write(line)
 
 
+
+def build(infile, chunkName="noweb.py", readme="README.md", encoding="utf-8"):
+    assert(infile)
+    assert(chunkName)
+    assert(encoding)
+
+    # Tangle the script and run the real build with the code we got, which
+    # makes sure it tangles itself exactly like we did
+    chunks = read(infile, encoding)
+    source = "".join(tangle(chunkName, chunks, "")).encode(encoding)
+    noweb = types.ModuleType(str("noweb"))
+    noweb.__file__ = chunkName
+    exec(compile(source, chunkName, "exec"), noweb.__dict__)
+    outputs = {
+        chunkName: chunkName,
+        readme: dict(default_code_syntax="python"),
+    }
+    return noweb.build(infile, outputs, encoding, {chunkName: source})
+
+
 def main():
     import argparse
 
@@ -78,8 +99,17 @@ def main():
         help='Input and output encoding (default: %(default)s)')
     cmd_line_parser.add_argument('-R', '--chunk', metavar='CHUNK',
         help='name of chunk to write to stdout')
+    cmd_line_parser.add_argument('--build', action='store_true',
+        help='build the script in chunk noweb.py (or CHUNK) and README.md '
+             'from FILE in this process')
     args = cmd_line_parser.parse_args()
 
+    if args.build:
+        for path in build(args.infile, args.chunk or "noweb.py",
+                encoding=args.encoding):
+            print("wrote %s" % (path,))
+        return
+
     chunks = read(args.infile, args.encoding)
     lines = tangle(args.chunk, chunks, "")
     write(lines, args.chunk, args.output, args.encoding)
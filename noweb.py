@@ -13,31 +13,80 @@ document.
 
 from __future__ import unicode_literals
 
-import argparse
-import ast
-import copy
-import imp
+import io
 import os
 import re
 import stat
 import sys
+import time
+import types
 import collections
 try:
-    from cStringIO import StringIO
+    basestring
+except NameError:
+    basestring = unicode = str
+try:
+    from itertools import izip as zip
 except ImportError:
-    from StringIO import StringIO
+    pass
+from itertools import chain, islice
+replace = getattr(os, 'replace', os.rename)
+timer = getattr(time, 'perf_counter', time.time)
+
 
-class RewriteLine(ast.NodeTransformer):
-    def __init__(self, line_map):
+class RewriteLine(object):
+    def __init__(self, line_map, col_shift=None):
         self.line_map = line_map
+        self.col_shift = col_shift
 
     def visit(self, node):
-        try:
-            node = copy.copy(node)
-            node.lineno = self.line_map[node.lineno]
-        except (AttributeError,KeyError):
-            pass
-        return super(RewriteLine, self).visit(node)
+        line_map = self.line_map
+        col_shift = self.col_shift
+        import ast
+        for child in ast.walk(node):
+            lineno = getattr(child, 'lineno', None)
+            if lineno is None:
+                continue
+            child.lineno = line_map[lineno]
+            col_offset = getattr(child, 'col_offset', None)
+            if col_shift is not None and col_offset is not None:
+                col_offset = child.col_offset = \
+                    max(0, col_offset - col_shift[lineno])
+
+            end_lineno = getattr(child, 'end_lineno', None)
+            if end_lineno is None:
+                continue
+            child.end_lineno = line_map[end_lineno]
+            end_col_offset = getattr(child, 'end_col_offset', None)
+            if col_shift is not None and end_col_offset is not None:
+                end_col_offset = child.end_col_offset = \
+                    max(0, end_col_offset - col_shift[end_lineno])
+            if (child.end_lineno, end_col_offset) < (child.lineno, col_offset):
+                child.end_lineno = child.lineno
+                child.end_col_offset = col_offset
+        return node
+
+def set_filenames(code, tangled, files):
+    """Name the file of the code objects in code after their lines.
+
+    tangled is the same code compiled with the line numbers of the tangled
+    source, files the file of every tangled line.
+    """
+    if not hasattr(code, 'replace'):
+        return code
+    import dis
+    consts = tuple(set_filenames(const, tangled_const, files)
+            if isinstance(const, types.CodeType) else const
+        for const, tangled_const in zip(code.co_consts, tangled.co_consts))
+    lines = set([tangled.co_firstlineno])
+    lines.update(lineno for start, lineno in dis.findlinestarts(tangled)
+        if lineno is not None)
+    names = set(files[lineno] for lineno in lines if 0 < lineno < len(files))
+    filename = names.pop() if len(names) == 1 else code.co_filename
+    return code.replace(co_filename=filename or code.co_filename,
+        co_consts=consts)
+
+
 class ImportHook(object):
     @classmethod
     def install(cls):
@@ -49,7 +98,16 @@ class ImportHook(object):
             except TypeError:
                 pass
         else:
-            sys.meta_path.append(cls())
+            # Python 2 consults meta_path before importing from sys.path, keep it
+            # that way on Python 3, whose path based finder lives in meta_path
+            try:
+                from importlib.machinery import PathFinder
+            except ImportError:
+                PathFinder = None
+            if PathFinder in sys.meta_path:
+                sys.meta_path.insert(sys.meta_path.index(PathFinder), cls())
+            else:
+                sys.meta_path.append(cls())
         for imp in sys.path_hooks:
             try:
                 if issubclass(cls, imp):
@@ -87,67 +145,117 @@ class ImportHook(object):
     def __init__(self, path=None):
         self.doc = None
         self.path = path
+        # Module information found by find_module, waiting for load_module
+        self._found = {}
         if self.path is None:
             return
 
         try:
             if not self.path.endswith('.nw') or not stat.S_ISREG(os.stat(self.path).st_mode):
                 raise ImportError(path)
-            self.doc = Reader()
-            self.doc.read(self.path)
+            self.doc = self._get_document(self.path)
         except (IOError, OSError):
             raise ImportError(path)
 
-    def _get_module_info(self, fullname):
-        prefix = fullname.replace('.', '/')
-        # Is it a regular module?
-        info = self._find_module_file(prefix, fullname)
-        if info is not None:
-            info['ispkg'] = False
-            return info
-
-        # Is it a package instead?
-        prefix = os.path.join(prefix, "__init__")
-        info = self._find_module_file(prefix, fullname)
-        if info is not None:
-            info['ispkg'] = True
-            return info
+    # Directory listings and parsed documents shared by every instance
+    _listings = {}
+    _documents = {}
+
+    def invalidate_caches(self):
+        """Forget every cached directory listing and parsed document."""
+        self._listings.clear()
+        self._documents.clear()
+
+    def _list_directory(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return frozenset()
+        cached = self._listings.get(directory)
+        if cached is None or cached[0] != mtime:
+            try:
+                entries = frozenset(os.listdir(directory))
+            except OSError:
+                entries = frozenset()
+            cached = self._listings[directory] = (mtime, entries)
+        return cached[1]
+
+    def _get_document(self, path):
+        """Return the parsed document at path, sharing it between imports."""
+        key = os.path.abspath(path)
+        doc = self._documents.get(key)
+        if doc is None or doc.changed():
+            doc = self._documents[key] = Reader(path)
+        return doc
+
+    def _get_module_info(self, fullname, path=None):
+        if self.doc is not None:
+            for chunk in (fullname, fullname + '.py'):
+                if chunk in self.doc.chunks:
+                    prefix = fullname + '.'
+                    ispkg = any(name and name.startswith(prefix)
+                        for name in self.doc.chunks)
+                    return dict(path=self.path, chunk=chunk, ispkg=ispkg)
+            raise ImportError(fullname)
+
+        name = fullname.rpartition('.')[2]
+        if path is None:
+            path = sys.path
+        for entry in path:
+            if not isinstance(entry, basestring):
+                continue
+            listing = self._list_directory(entry or os.curdir)
+            # Is it a regular module?
+            if name + '.py.nw' in listing:
+                return self._module_file_info(
+                    os.path.join(entry, name + '.py.nw'), False)
+            # Is it a package instead?
+            if name in listing and '__init__.py.nw' in self._list_directory(
+                    os.path.join(entry or os.curdir, name)):
+                return self._module_file_info(
+                    os.path.join(entry, name, '__init__.py.nw'), True)
 
         # Can't find the module
         raise ImportError(fullname)
 
-    def _find_module_file(self, prefix, fullname):
-        try:
-            chunk = None
-            if   fullname         in self.doc.chunks:
-                chunk = fullname
-            elif fullname + '.py' in self.doc.chunks:
-                chunk = fullname + '.py'
-            if chunk:
-                bc_file = os.path.join(os.path.dirname(self.path), fullname + '.py')
-                return dict(path=self.path, chunk=chunk)
-        except AttributeError:
-            pass
+    def _module_file_info(self, path, ispkg):
+        chunk = os.path.basename(os.path.realpath(path))[:-len('.nw')]
+        return dict(path=path, chunk=chunk, ispkg=ispkg)
 
-        path = prefix + '.py.nw'
+    def find_spec(self, fullname, path=None, target=None):
+        """Return a spec for the given module if we can find it."""
         try:
-            statinfo = os.stat(path)
-            chunk = os.path.basename(os.path.realpath(path))[:-len('.nw')]
-            if stat.S_ISREG(statinfo.st_mode):
-                return dict(path=path, chunk=chunk)
-        except OSError:
-            pass
-
-        return None
+            info = self._get_module_info(fullname, path)
+        except ImportError:
+            return None
+        from importlib.machinery import ModuleSpec
+        spec = ModuleSpec(fullname, self, origin=info['path'],
+            loader_state=info, is_package=info['ispkg'])
+        if info['ispkg']:
+            spec.submodule_search_locations = [self.path if self.doc is not None
+                else os.path.dirname(info['path'])]
+        return spec
 
     def find_module(self, fullname, path=None):
         """Try to discover if we can find the given module."""
         try:
-            self._get_module_info(fullname)
+            self._found[fullname] = self._get_module_info(fullname, path)
         except ImportError:
             return None
         else:
             return self
+
+    def create_module(self, spec):
+        """Use the default module creation semantics."""
+        return None
+
+    def exec_module(self, module):
+        """Execute the chunk of the module in its namespace."""
+        info = module.__spec__.loader_state
+        code = self.get_code(module.__name__, info)
+        module.__file__ = info['chunk']
+        exec(code, module.__dict__)
+
     def load_module(self, fullname):
         """Load the specified module.
 
@@ -159,28 +267,30 @@ class ImportHook(object):
         except KeyError:
             pass
 
-        info = self._get_module_info(fullname)
+        info = self._found.pop(fullname, None)
+        if info is None:
+            info = self._get_module_info(fullname)
         code = self.get_code(fullname, info)
         if code is None:
             raise ImportError(fullname)
-        module = imp.new_module(fullname)
+        module = types.ModuleType(str(fullname))
         module.__file__ = info['chunk']
         module.__loader__ = self
+        if info['ispkg']:
+            module.__path__ = [self.path if self.doc is not None
+                else os.path.dirname(info['path'])]
         sys.modules[fullname] = module
         try:
-            exec code in module.__dict__
-            if self.path is None:
-                module.__path__ = []
-            else:
-                module.__path__ = [self.path]
+            exec(code, module.__dict__)
         except:
             sys.modules.pop(fullname, None)
             raise
         return module
+
     def get_data(self, path):
         if self.doc is None or not path in self.doc.chunks:
             raise IOError(path)
-        return self.doc.write(path)
+        return self.doc.write(self.doc.tangle(path))
 
     def is_package(self, fullname, info=None):
         if info is None:
@@ -190,44 +300,122 @@ class ImportHook(object):
     def get_code(self, fullname, info=None):
         if info is None:
             info = self._get_module_info(fullname)
-        doc = self.doc
-        if doc is None:
-            with open(info['path'], 'U') as f:
-                doc = Reader()
-                doc.read(f)
-
-        # Convert to string, while building a line-number conversion table
-        outsrc = StringIO()
-        line_map = {}
-        for outlnum, line in enumerate(doc.tangle(info['chunk'])):
-            inlnum = line.position
-            outlnum += 1
-            line_map[outlnum] = inlnum
-            outsrc.write(line.value.encode(doc.encoding))
+        if self.cache_bytecode:
+            cache_path = self._cache_path(info)
+            key = self._cache_key(info)
+            code = self._load_cached_code(cache_path, key)
+            if code is not None:
+                return code
+
+        doc = self._get_document(info['path'])
+
+        # Convert to string, while building line and column conversion tables
+        # indexed by the line number in the output (which starts at 1)
+        lines = doc.tangle(info['chunk'])
+        line_map = [0]
+        line_map.extend(line.position for line in lines)
+        col_shift = [0]
+        col_shift.extend(len(line.indentation) for line in lines)
 
         # Parse output string to AST
-        node = ast.parse(outsrc.getvalue(), info['path'], 'exec')
+        import ast
+        source = doc.write(lines)
+        node = ast.parse(source, info['path'], 'exec')
         # Rewrite line numbers on AST
-        node = RewriteLine(line_map).visit(node)
-        return compile(node, info['path'], 'exec')
+        node = RewriteLine(line_map, col_shift).visit(node)
+        code = compile(node, info['path'], 'exec')
+        # Point the functions and classes of included chunks to their files
+        files = [None] + [line.file for line in lines]
+        if any(fname != info['path'] for fname in files[1:]):
+            code = set_filenames(code,
+                compile(source, info['path'], 'exec'), files)
+        if self.cache_bytecode:
+            self._store_cached_code(cache_path, key, code, doc.files)
+        return code
 
     def get_source(self, fullname, info=None):
         if info is None:
             info = self._get_module_info(fullname)
-        with open(info['path'], 'U') as f:
-            return f.read()
+        with open(info['path'], 'rb') as f:
+            source = f.read()
+        return source.decode(self._get_document(info['path']).encoding or 'utf-8')
 
     def get_filename(self, fullname, info=None):
         if info is None:
             info = self._get_module_info(fullname)
         return info['path']
+
+    cache_bytecode = True
+
+    def _magic_number(self):
+        try:
+            from importlib.util import MAGIC_NUMBER
+        except ImportError:
+            from imp import get_magic
+            MAGIC_NUMBER = get_magic()
+        return MAGIC_NUMBER
+
+    def _cache_path(self, info):
+        import hashlib
+        dirname, basename = os.path.split(info['path'])
+        chunk = hashlib.sha1(info['chunk'].encode('utf-8')).hexdigest()[:8]
+        return os.path.join(dirname, '__pycache__', '%s.%s.py%d%d.nwc' % (
+            (basename, chunk) + tuple(sys.version_info[:2])))
+
+    def _cache_key(self, info):
+        statinfo = os.stat(info['path'])
+        return (statinfo.st_mtime, statinfo.st_size, info['chunk'],
+            tuple(_file_stamp(__file__) or ()))
+
+    def _load_cached_code(self, cache_path, key):
+        import marshal
+        magic = self._magic_number()
+        try:
+            with open(cache_path, 'rb') as f:
+                if f.read(len(magic)) != magic:
+                    return None
+                cached_key, files, code = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if tuple(cached_key) != key:
+            return None
+        if any(_file_stamp(fname) != list(stamp) for fname, stamp in files):
+            return None
+        return code
+
+    def _store_cached_code(self, cache_path, key, code, files=()):
+        if sys.dont_write_bytecode:
+            return
+        import marshal
+        tmp_path = '%s.%d' % (cache_path, os.getpid())
+        try:
+            dirname = os.path.dirname(cache_path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(tmp_path, 'wb') as f:
+                f.write(self._magic_number())
+                marshal.dump((key, list(files), code), f)
+            replace(tmp_path, cache_path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+class DocumentError(ValueError):
+    """A mistake in a document, reported without a traceback."""
+
+
+
 Chunk = collections.namedtuple("Chunk",
-    ["syntax", "lines", "position"])
+    ["syntax", "lines", "position", "file"])
+Chunk.__new__.__defaults__ = (None,)
 
 
 
 class Line(collections.namedtuple("Line",
-    ["type", "value", "indentation", "position"])):
+    ["type", "value", "indentation", "position", "file"])):
     __slots__ = ()
 
     DOCUMENTATION = 1
@@ -239,6 +427,886 @@ class Line(collections.namedtuple("Line",
     def __str__(self):
         return "".join([self.indentation, self.value])
 
+Line.__new__.__defaults__ = (None,)
+
+
+class TextBuffer(object):
+    """Text shared by the LineArrays of a document."""
+
+    def __init__(self):
+        self._text = ""
+        self._stream = None
+        self._size = 0
+        self._strings = []
+        self._indexes = {}
+
+    def add(self, text):
+        """Append text and return its start and end offsets."""
+        if self._stream is None:
+            self._stream = io.StringIO(self._text)
+            self._stream.seek(0, io.SEEK_END)
+        self._stream.write(text)
+        start = self._size
+        self._size += len(text)
+        return start, self._size
+
+    def get(self, start, end):
+        if self._stream is not None:
+            self.freeze()
+        return self._text[start:end]
+
+    def freeze(self):
+        """Turn the text appended so far into a single string."""
+        if self._stream is not None:
+            self._text = self._stream.getvalue()
+            self._stream = None
+
+    def intern(self, string):
+        """Return the index of a string in the table of interned strings."""
+        index = self._indexes.get(string)
+        if index is None:
+            index = self._indexes[string] = len(self._strings)
+            self._strings.append(string)
+        return index
+
+    def interned(self, index):
+        return self._strings[index]
+
+
+class LineArray(object):
+    """A list of Lines stored in arrays."""
+
+    # Lines whose value is a chunk name, which gets interned
+    NAMES = (Line.CHUNK_BEGIN, Line.REFERENCE)
+
+    def __init__(self, text, lines=()):
+        import array
+        self._text = text
+        self._types = array.array(str('B'))
+        self._positions = array.array(str('i'))
+        # Offsets of the value in the text, or index of the interned name
+        self._starts = array.array(str('i'))
+        self._ends = array.array(str('i'))
+        # Index of the interned indentation and file name
+        self._indents = array.array(str('i'))
+        self._files = array.array(str('i'))
+        self.extend(lines)
+
+    def append(self, line):
+        type, value, indentation, position, file = line
+        if type in self.NAMES:
+            start, end = self._text.intern(value), 0
+        else:
+            start, end = self._text.add(value)
+        self._types.append(type)
+        self._positions.append(position)
+        self._starts.append(start)
+        self._ends.append(end)
+        self._indents.append(self._text.intern(indentation))
+        self._files.append(self._text.intern(file))
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def _line(self, type, position, start, end, indent, file):
+        text = self._text
+        if type in self.NAMES:
+            value = text.interned(start)
+        else:
+            value = text.get(start, end)
+        return Line(type, value, text.interned(indent), position,
+            text.interned(file))
+
+    def __len__(self):
+        return len(self._types)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self._line(self._types[index], self._positions[index],
+            self._starts[index], self._ends[index], self._indents[index],
+            self._files[index])
+
+    def __iter__(self):
+        line = self._line
+        for fields in zip(self._types, self._positions, self._starts,
+                self._ends, self._indents, self._files):
+            yield line(*fields)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "LineArray(%r)" % (list(self),)
+
+
+class LazyLines(object):
+    """Lines of a chunk that are parsed from the file when first needed."""
+
+    def __init__(self, reader, chunkName):
+        self._reader = reader
+        self._chunkName = chunkName
+        # Lines, and (data, start, end, lnum) parts of the file to parse
+        self._parts = []
+        self._lines = None
+
+    def add(self, data, start, end, lnum, fname=None):
+        """Add the lines in data[start:end], the first being lnum + 1."""
+        if start < end:
+            self._parts.append((data, start, end, lnum, fname))
+
+    def append(self, line):
+        if self._lines is not None:
+            self._lines.append(line)
+        else:
+            self._parts.append(line)
+
+    def _load(self):
+        if self._lines is None:
+            lines = self._reader._new_lines()
+            for part in self._parts:
+                if isinstance(part, Line):
+                    lines.append(part)
+                else:
+                    data, start, end, lnum, fname = part
+                    self._reader._read_lines(io.BytesIO(data[start:end]),
+                        lnum, self._chunkName, lines, fname)
+            self._lines = lines
+            self._parts = None
+        return self._lines
+
+    def __len__(self):
+        return len(self._load())
+
+    def __getitem__(self, index):
+        return self._load()[index]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "LazyLines(%r)" % (list(self),)
+
+
+class Regions(object):
+    """Lengths, in lines, of the consecutive regions of a document."""
+
+    def __init__(self, lengths):
+        tree = [0]
+        tree.extend(lengths)
+        for index in range(1, len(tree)):
+            parent = index + (index & -index)
+            if parent < len(tree):
+                tree[parent] += tree[index]
+        self._tree = tree
+        self.size = len(lengths)
+        # Where the regions started when the document was read
+        self.starts = []
+        position = 1
+        for length in lengths:
+            self.starts.append(position)
+            position += length
+        # Changes whenever a region moves, for the shifts known before
+        self.generation = 0
+
+    def start(self, region):
+        """Return the position of the first line of region."""
+        position = 1
+        while region > 0:
+            position += self._tree[region]
+            region -= region & -region
+        return position
+
+    def shift(self, region):
+        """Return by how many lines region moved since the document was
+        read."""
+        return self.start(region) - self.starts[region]
+
+    def resize(self, region, delta):
+        """Add delta lines to region, moving the regions after it."""
+        tree = self._tree
+        index = region + 1
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+        self.generation += 1
+
+    def find(self, position):
+        """Return the region of the line at position."""
+        # The last region that starts at position or before it
+        tree = self._tree
+        region, before = 0, position - 1
+        step = 1
+        while step <= self.size:
+            step <<= 1
+        while step:
+            if region + step <= self.size and tree[region + step] <= before:
+                region += step
+                before -= tree[region]
+            step >>= 1
+        return region
+
+
+class ShiftedLines(object):
+    """Lines of some regions of a document, whose positions are moved as the
+    lines are read."""
+
+    def __init__(self, regions, segments):
+        self._regions = regions
+        # (region, lines) pairs, whose lines have the positions they had when
+        # the document was read, or when their region was last edited
+        self._segments = segments
+        self._shifts = [None] * len(segments)
+        self._offsets = None
+
+    def _shift(self, segment):
+        shift = self._shifts[segment]
+        generation = self._regions.generation
+        if shift is None or shift[0] != generation:
+            shift = self._shifts[segment] = (generation,
+                self._regions.shift(self._segments[segment][0]))
+        return shift[1]
+
+    def _locate(self, index):
+        """Return the segment of the line at index, and its index there."""
+        import bisect
+        if self._offsets is None:
+            offsets = [0]
+            for region, lines in self._segments:
+                offsets.append(offsets[-1] + len(lines))
+            self._offsets = offsets
+        if index < 0:
+            index += self._offsets[-1]
+        if not 0 <= index < self._offsets[-1]:
+            raise IndexError("line index out of range")
+        segment = bisect.bisect_right(self._offsets, index) - 1
+        return segment, index - self._offsets[segment]
+
+    def edit(self, segment, start, end, lines, delta):
+        """Replace the lines of segment at positions start to end, end
+        excluded, by lines, moving those after them by delta. Returns the
+        lines replaced."""
+        stored = self._segments[segment][1]
+        shift = self._shift(segment)
+        first = _first_at(stored, start - shift)
+        after = _first_at(stored, end - shift)
+        old = stored[first:after]
+        stored[first:after] = _moved(lines, -shift) if shift else lines
+        moved = first + len(lines)
+        if delta:
+            stored[moved:] = _moved(stored[moved:], delta)
+        if len(lines) != after - first:
+            self._offsets = None
+        return _moved(old, shift) if shift else old
+
+    def __len__(self):
+        if len(self._segments) == 1:
+            return len(self._segments[0][1])
+        if self._offsets is None:
+            self._locate(0)
+        return self._offsets[-1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        segment, index = self._locate(index)
+        line = self._segments[segment][1][index]
+        shift = self._shift(segment)
+        return line._replace(position=line.position + shift) if shift else line
+
+    def __iter__(self):
+        if len(self._segments) == 1 and not self._shift(0):
+            return iter(self._segments[0][1])
+        return self._shifted()
+
+    def _shifted(self):
+        new = tuple.__new__
+        for segment, (region, lines) in enumerate(self._segments):
+            shift = self._shift(segment)
+            if not shift:
+                for line in lines:
+                    yield line
+                continue
+            for type, value, indentation, position, file in lines:
+                yield new(Line, (type, value, indentation, position + shift,
+                    file))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "ShiftedLines(%r)" % (list(self),)
+
+
+class ShiftedChunks(dict):
+    """Chunks of an editable document, whose positions are moved as the chunks
+    are read."""
+
+    def __getitem__(self, name):
+        return _shifted_chunk(dict.__getitem__(self, name))
+
+    def get(self, name, default=None):
+        chunk = dict.get(self, name)
+        return default if chunk is None else _shifted_chunk(chunk)
+
+    def items(self):
+        return [(name, _shifted_chunk(chunk))
+            for name, chunk in dict.items(self)]
+
+    def values(self):
+        return [_shifted_chunk(chunk) for chunk in dict.values(self)]
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "ShiftedChunks(%r)" % (dict(self.items()),)
+
+
+def _shifted_chunk(chunk):
+    """Return chunk at the position its lines moved to."""
+    lines = chunk.lines
+    shift = lines._shift(0) if isinstance(lines, ShiftedLines) else 0
+    return chunk._replace(position=chunk.position + shift) if shift else chunk
+
+
+def _first_at(lines, position):
+    """Return the index of the first of lines at position or after it."""
+    low, high = 0, len(lines)
+    while low < high:
+        middle = (low + high) // 2
+        if lines[middle].position < position:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def _moved(lines, delta):
+    # tuple.__new__ skips the __new__ of the namedtuple, a third of the time
+    new = tuple.__new__
+    return [new(Line, (type, value, indentation, position + delta, file))
+        for type, value, indentation, position, file in lines]
+
+
+class Formatter(object):
+    """Turns a document into text of some format, a fragment at a time."""
+
+    extension = ''
+
+    def __init__(self, doc, add_links=False, cross_references=False,
+            index=False, highlight=None, cache=None, **options):
+        self.doc = doc
+        self.add_links = add_links
+        self.cross_referenced = cross_references
+        self.index = index
+        self.options = options
+        # The chunks woven into the document and the users of every chunk
+        self.woven = self.users = None
+        if cross_references or index:
+            self.woven = set(line.value for line in doc.chunks[None].lines
+                if line.type == Line.CHUNK_BEGIN)
+            self.users = doc.users()
+        # The style to highlight code in, when Pygments is installed
+        self.style = 'default' if highlight is True else highlight or None
+        self.pygments = None
+        if self.style:
+            try:
+                import pygments
+                self.pygments = pygments
+            except ImportError:
+                pass
+        self.lexers = {}
+        # Directory keeping rendered chunks, if any
+        self.cache = cache
+
+    def begin(self):
+        """Yield the text preceding the document."""
+        return ()
+
+    def documentation(self, lines):
+        """Yield the text of a run of documentation lines."""
+        for line in lines:
+            yield line.indentation
+            yield line.value
+
+    def chunk(self, name, lines, syntax):
+        """Yield the text of the chunk name, made of lines in syntax."""
+        yield self.chunk_heading(name, syntax)
+
+        uses = []
+        for line in lines:
+            yield line.indentation
+            if line.type == Line.REFERENCE:
+                uses.append(line.value)
+                yield "".join(["<<", line.value, ">>", "\n"])
+            elif syntax or line.value in ('', '\n', '\r\n'):
+                yield line.value
+            else:
+                yield "    "
+                yield line.value
+
+        yield '```\n' if syntax else "\n"
+        if self.cross_referenced:
+            references = self.cross_references(name, uses)
+            if references:
+                yield "\n%s\n" % (references,)
+
+    def chunk_heading(self, name, syntax):
+        """Return the heading with the chunk's name opening its code block."""
+        heading = ["\n###### ", name]
+        if self.add_links:
+            heading.extend([' <a name="', self.anchor(name), '"></a>'])
+        heading.append("\n\n")
+        if syntax:
+            heading.append("```%s\n" % (syntax,))
+        return "".join(heading)
+
+    def chunk_link(self, name):
+        """Return a link to the chunk name."""
+        if self.add_links and self.woven is not None and name in self.woven:
+            return "[%s](#%s)" % (name, self.anchor(name))
+        return name
+
+    def end(self):
+        """Yield the text following the document."""
+        if not self.index:
+            return
+        yield "\n###### Index of chunks\n\n"
+        for name, users in self.indexed():
+            yield "- %s%s\n" % (self.chunk_link(name), ", used by %s" % (
+                ", ".join(self.chunk_link(user) for user in users),)
+                if users else "")
+
+    def anchor(self, name):
+        return "-".join(name.split()).lower()
+
+    def cross_references(self, name, uses):
+        """Return the text linking to the chunks name uses and is used by."""
+        seen = set()
+        uses = [use for use in uses if use not in seen and not seen.add(use)]
+        sentences = []
+        if uses:
+            sentences.append("Uses %s." % (
+                ", ".join(self.chunk_link(use) for use in uses),))
+        if self.users.get(name):
+            sentences.append("Used by %s." % (
+                ", ".join(self.chunk_link(user) for user in self.users[name]),))
+        return " ".join(sentences)
+
+    def indexed(self):
+        """Return the woven chunks, by name, with the chunks using them."""
+        return [(name, self.users.get(name, [])) for name in sorted(self.woven,
+            key=lambda name: (name.lower(), name))]
+
+    def lexer(self, syntax):
+        """Return the Pygments lexer to highlight syntax with, if any."""
+        if self.pygments is None or not syntax:
+            return None
+        if syntax not in self.lexers:
+            from pygments.lexers import get_lexer_by_name
+            from pygments.util import ClassNotFound
+            try:
+                # Leading and trailing blank lines belong to the chunk too
+                self.lexers[syntax] = get_lexer_by_name(syntax, stripnl=False,
+                    ensurenl=False)
+            except ClassNotFound:
+                self.lexers[syntax] = None
+        return self.lexers[syntax]
+
+    def chunk_key(self, lines, syntax):
+        """Return what the highlighted lines of a chunk depend on."""
+        key = [type(self).__name__, self.pygments.__version__, syntax]
+        key.extend("%d %s%s" % (line.type, line.indentation,
+                self.chunk_link(line.value) if line.type == Line.REFERENCE
+                else line.value)
+            for line in lines)
+        return "\0".join(key)
+
+    def cached(self, key, render):
+        """Return render(), or what it returned for the same key before."""
+        if self.cache is None:
+            return render()
+        import hashlib
+        path = os.path.join(self.cache,
+            hashlib.sha1(key.encode('utf-8')).hexdigest())
+        try:
+            with open(path, 'rb') as f:
+                return f.read().decode('utf-8')
+        except IOError:
+            pass
+        text = render()
+        try:
+            if not os.path.isdir(self.cache):
+                os.makedirs(self.cache)
+            _write_bytes(path, text.encode('utf-8'), atomic=True)
+        except (IOError, OSError):
+            pass
+        return text
+
+
+class MarkdownFormatter(Formatter):
+    extension = '.md'
+
+markdown_block_re = re.compile(r'''
+    (?P<blank>\s*$) |
+    (?:\ {4}|\t)(?P<code>.*) |
+    \ {0,3}(?:
+        (?P<fence>```|~~~).* |
+        (?P<heading>\#{1,6})\s+(?P<title>.*?)(?:\s+\#+)?\s*$ |
+        (?P<rule>[-*_])(?:[ \t]*(?P=rule)){2,}[ \t]*$ |
+        (?:(?P<bullet>[-*+])|\d+[.)])\s+(?P<item>.*)
+    )''', re.VERBOSE)
+
+markdown_inline_re = re.compile(r'''
+    `+(?P<code>.+?)`+ |
+    \*\*(?P<strong>.+?)\*\* |
+    (?<!\w)[*_](?P<emphasis>[^*_\s](?:.*?[^*_\s])?)[*_](?!\w) |
+    !\[(?P<alt>[^\]]*)\]\((?P<source>[^)\s]*)[^)]*\) |
+    \[(?P<text>(?:[^[\]]|\[[^\]]*\])*)\]\((?P<url>[^)\s]*)[^)]*\) |
+    <(?P<link>https?://[^>\s]+)>''', re.VERBOSE)
+
+def _markdown_block(kind, text):
+    if kind == 'pre':
+        return kind, "\n".join(text).rstrip('\n')
+    return kind, " ".join(text)
+
+def markdown_blocks(lines):
+    """Yield the blocks of some lines of Markdown as (kind, text) pairs.
+
+    kind is one of 'h1' to 'h6', 'p', 'pre', 'hr', or 'ul' and 'ol' for every
+    item of a list.
+    """
+    kind, text, fence = None, [], None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if fence is not None:
+            if line.strip().startswith(fence):
+                yield _markdown_block(kind, text)
+                kind, text, fence = None, [], None
+            else:
+                text.append(line)
+            continue
+
+        match = markdown_block_re.match(line)
+        if match is None or (match.group('code') is not None
+                and kind in ('p', 'ul', 'ol')):
+            # Text continues the paragraph or list item it follows
+            if kind not in ('p', 'ul', 'ol'):
+                if kind:
+                    yield _markdown_block(kind, text)
+                kind, text = 'p', []
+            text.append(line.strip())
+            continue
+        if match.group('code') is not None or (kind == 'pre'
+                and match.group('blank') is not None):
+            if kind != 'pre':
+                if kind:
+                    yield _markdown_block(kind, text)
+                kind, text = 'pre', []
+            text.append(match.group('code') or '')
+            continue
+
+        if kind:
+            yield _markdown_block(kind, text)
+        kind, text = None, []
+        if match.group('fence'):
+            kind, fence = 'pre', match.group('fence')
+        elif match.group('heading'):
+            yield 'h%d' % (len(match.group('heading')),), match.group('title')
+        elif match.group('rule'):
+            yield 'hr', ''
+        elif match.group('item') is not None:
+            kind = 'ul' if match.group('bullet') else 'ol'
+            text = [match.group('item')]
+    if kind:
+        yield _markdown_block(kind, text)
+
+class MarkupFormatter(Formatter):
+    """A formatter writing Markdown documentation in another markup."""
+
+    # Templates of the blocks, lists (start and end) and inline markup; images
+    # are linked to when there is no template for them
+    blocks = {}
+    lists = {}
+    item = '%s'
+    code = strong = emphasis = '%s'
+    link = '%s%s'
+    image = None
+
+    def escape(self, text):
+        return text
+
+    def escape_code(self, text):
+        return self.escape(text)
+
+    def documentation(self, lines):
+        listing = None
+        for kind, text in markdown_blocks(line.indentation + line.value
+                for line in lines):
+            if kind != listing:
+                if listing:
+                    yield self.lists[listing][1]
+                listing = kind if kind in self.lists else None
+                if listing:
+                    yield self.lists[listing][0]
+            if listing:
+                yield self.item % (self.inline(text),)
+            elif kind == 'pre':
+                yield self.blocks[kind] % (self.escape_code(text),)
+            elif kind == 'hr':
+                yield self.blocks[kind]
+            else:
+                yield self.blocks[kind] % (self.inline(text),)
+        if listing:
+            yield self.lists[listing][1]
+
+    def inline(self, text):
+        """Return the markup of a line of Markdown text."""
+        fragments = []
+        start = 0
+        for match in markdown_inline_re.finditer(text):
+            fragments.append(self.escape(text[start:match.start()]))
+            start = match.end()
+            code, strong, emphasis, source, url, link = match.group('code',
+                'strong', 'emphasis', 'source', 'url', 'link')
+            if code is not None:
+                fragments.append(self.code % (self.escape(code),))
+            elif strong is not None:
+                fragments.append(self.strong % (self.inline(strong),))
+            elif emphasis is not None:
+                fragments.append(self.emphasis % (self.inline(emphasis),))
+            elif source is not None:
+                fragments.append((self.image or self.link) % (
+                    self.escape_url(source), self.escape(match.group('alt'))))
+            elif url is not None:
+                fragments.append(self.link % (self.escape_url(url),
+                    self.inline(match.group('text'))))
+            else:
+                fragments.append(self.link % (self.escape_url(link),
+                    self.escape(link)))
+        fragments.append(self.escape(text[start:]))
+        return "".join(fragments)
+
+    def escape_url(self, url):
+        return self.escape(url)
+
+
+class HtmlFormatter(MarkupFormatter):
+    extension = '.html'
+
+    blocks = dict([('h%d' % (level,), '<h%d>%%s</h%d>\n' % (level, level))
+            for level in range(1, 7)],
+        p='<p>%s</p>\n', pre='<pre><code>%s</code></pre>\n', hr='<hr>\n')
+    lists = dict(ul=('<ul>\n', '</ul>\n'), ol=('<ol>\n', '</ol>\n'))
+    item = '<li>%s</li>\n'
+    code = '<code>%s</code>'
+    strong = '<strong>%s</strong>'
+    emphasis = '<em>%s</em>'
+    link = '<a href="%s">%s</a>'
+    image = '<img src="%s" alt="%s">'
+    # The Pygments formatter of highlighted code, once there is some
+    code_formatter = None
+
+    def escape(self, text):
+        return text.replace('&', '&amp;').replace('<', '&lt;') \
+            .replace('>', '&gt;').replace('"', '&quot;')
+
+    def begin(self):
+        title = os.path.basename(self.doc.last_fname or '')
+        yield ('<!DOCTYPE html>\n<html>\n<head>\n'
+            '<meta charset="%s">\n<title>%s</title>\n%s</head>\n<body>\n'
+            % (self.doc.encoding or 'utf-8', self.escape(title),
+                self.style_sheet()))
+
+    def style_sheet(self):
+        if self.pygments is None:
+            return ''
+        from pygments.formatters import HtmlFormatter as PygmentsFormatter
+        return '<style>\n%s\n</style>\n' % (PygmentsFormatter(
+            style=self.style).get_style_defs('.chunk code'),)
+
+    def chunk(self, name, lines, syntax):
+        anchor = self.escape(self.anchor(name))
+        yield '<div class="chunk"%s>\n' % (
+            ' id="%s"' % (anchor,) if self.add_links else '',)
+        yield '<p class="chunk-name">&lt;&lt;%s&gt;&gt;=</p>\n' % (
+            self.escape(name),)
+        yield '<pre><code%s>' % (' class="language-%s"'
+            % (self.escape(syntax),) if syntax else '',)
+        lexer = self.lexer(syntax)
+        if lexer is not None:
+            yield self.cached(self.chunk_key(lines, syntax),
+                lambda: "".join(self.highlighted(lines, lexer)))
+            uses = [line.value for line in lines
+                if line.type == Line.REFERENCE]
+        else:
+            uses = []
+            for line in lines:
+                yield line.indentation
+                if line.type != Line.REFERENCE:
+                    yield self.escape(line.value)
+                else:
+                    uses.append(line.value)
+                    yield self.chunk_link(line.value)
+                    yield '\n'
+        yield '</code></pre>\n'
+        if self.cross_referenced:
+            references = self.cross_references(name, uses)
+            if references:
+                yield '<p class="chunk-references">%s</p>\n' % (references,)
+        yield '</div>\n'
+
+    def chunk_link(self, name):
+        if self.add_links and (self.woven is None or name in self.woven):
+            return '<a href="#%s">&lt;&lt;%s&gt;&gt;</a>' % (
+                self.escape(self.anchor(name)), self.escape(name))
+        return '&lt;&lt;%s&gt;&gt;' % (self.escape(name),)
+
+    def highlighted(self, lines, lexer):
+        """Yield lines in HTML, the code between references highlighted."""
+        from pygments import highlight
+        if self.code_formatter is None:
+            from pygments.formatters import HtmlFormatter as PygmentsFormatter
+            self.code_formatter = PygmentsFormatter(nowrap=True)
+        code = []
+        for line in chain(lines, [None]):
+            if line is not None and line.type != Line.REFERENCE:
+                code.append(line.indentation + line.value)
+                continue
+            if code:
+                yield highlight("".join(code), lexer, self.code_formatter)
+                code = []
+            if line is not None:
+                yield line.indentation
+                yield self.chunk_link(line.value)
+                yield '\n'
+
+    def end(self):
+        if self.index:
+            yield '<h2>Index of chunks</h2>\n<ul class="chunk-index">\n'
+            for name, users in self.indexed():
+                yield '<li>%s%s</li>\n' % (self.chunk_link(name),
+                    ', used by %s' % (", ".join(self.chunk_link(user)
+                        for user in users),) if users else '')
+            yield '</ul>\n'
+        yield '</body>\n</html>\n'
+
+
+latex_specials = {
+    '\\': '\\textbackslash{}', '{': '\\{', '}': '\\}', '$': '\\$',
+    '&': '\\&', '#': '\\#', '^': '\\textasciicircum{}', '_': '\\_',
+    '%': '\\%', '~': '\\textasciitilde{}',
+}
+latex_special_re = re.compile(r'[\\{}$&#^_%~]')
+latex_verbatim_end = '\\end{verbatim}'
+
+class LatexFormatter(MarkupFormatter):
+    extension = '.tex'
+
+    blocks = dict(h1='\\section*{%s}\n\n', h2='\\subsection*{%s}\n\n',
+        h3='\\subsubsection*{%s}\n\n', h4='\\paragraph*{%s}\n\n',
+        h5='\\subparagraph*{%s}\n\n', h6='\\subparagraph*{%s}\n\n',
+        p='%s\n\n', pre='\\begin{verbatim}\n%s\n\\end{verbatim}\n\n',
+        hr='\\noindent\\rule{\\linewidth}{0.4pt}\n\n')
+    lists = dict(ul=('\\begin{itemize}\n', '\\end{itemize}\n\n'),
+        ol=('\\begin{enumerate}\n', '\\end{enumerate}\n\n'))
+    item = '\\item %s\n'
+    code = '\\texttt{%s}'
+    strong = '\\textbf{%s}'
+    emphasis = '\\emph{%s}'
+    link = '\\href{%s}{%s}'
+
+    def escape(self, text):
+        return latex_special_re.sub(lambda match:
+            latex_specials[match.group()], text)
+
+    def escape_code(self, text):
+        if latex_verbatim_end not in text:
+            return text
+        # verbatim ends at the first \end{verbatim}, wherever it is, so the
+        # lines with one are set outside of it
+        return "\n".join('\\end{verbatim}\n\\noindent\\texttt{%s}\n'
+                '\\begin{verbatim}' % (self.escape(line).replace(' ', '~'),)
+            if latex_verbatim_end in line else line
+            for line in text.split("\n"))
+
+    def escape_url(self, url):
+        return url.replace('\\', '\\\\').replace('%', '\\%') \
+            .replace('#', '\\#')
+
+    def begin(self):
+        yield ('\\documentclass{article}\n\\usepackage{hyperref}\n'
+            '\\begin{document}\n\n')
+
+    def anchor(self, name):
+        # Only some characters can be used in the names of hypertargets
+        import binascii
+        return 'chunk:' + binascii.hexlify(name.encode('utf-8')) \
+            .decode('ascii')
+
+    def chunk(self, name, lines, syntax):
+        title = '$\\langle$%s$\\rangle\\equiv$' % (self.escape(name),)
+        if self.add_links and self.woven is not None:
+            title = '\\hypertarget{%s}{%s}' % (self.anchor(name), title)
+        yield '\\noindent%s\n\\begin{verbatim}\n' % (title,)
+        uses = []
+        for line in lines:
+            if line.type == Line.REFERENCE:
+                uses.append(line.value)
+                yield line.indentation
+                yield "".join(["<<", line.value, ">>", "\n"])
+            elif latex_verbatim_end in line.value:
+                yield self.escape_code(line.indentation + line.value)
+            else:
+                yield line.indentation
+                yield line.value
+        yield '\\end{verbatim}\n\n'
+        if self.cross_referenced:
+            references = self.cross_references(name, uses)
+            if references:
+                yield '\\noindent %s\n\n' % (references,)
+
+    def chunk_link(self, name):
+        text = '$\\langle$%s$\\rangle$' % (self.escape(name),)
+        if self.add_links and self.woven is not None and name in self.woven:
+            return '\\hyperlink{%s}{%s}' % (self.anchor(name), text)
+        return text
+
+    def end(self):
+        if self.index:
+            yield '\\section*{Index of chunks}\n\n\\begin{itemize}\n'
+            for name, users in self.indexed():
+                yield '\\item %s%s\n' % (self.chunk_link(name),
+                    ', used by %s' % (", ".join(self.chunk_link(user)
+                        for user in users),) if users else '')
+            yield '\\end{itemize}\n\n'
+        yield '\\end{document}\n'
+
 
 class Reader(object):
     chunk_re         = re.compile(r'<<(?:(?P<syntax>[^:]+):)?(?P<name>[^>]+)>>')
@@ -252,73 +1320,411 @@ class Reader(object):
         + r'\s*'
         + r')*.*\s*$')
 
-    def __init__(self, file=None, encoding=None):
+    def __init__(self, file=None, encoding=None, compact=False, lazy=False,
+            editable=False):
+        if lazy and editable:
+            raise ValueError("A lazy reader can't be editable")
+        if compact and editable:
+            raise ValueError("A compact reader can't be editable")
+        # Lines are stored in LineArrays sharing a TextBuffer when compact
+        self.compact = compact
+        self._text = TextBuffer() if compact else None
+        # Files are memory-mapped and chunks parsed on demand when lazy
+        self.lazy = lazy
+        # Hooks watching this reader only, global_hooks watch every reader
+        self.hooks = []
+        # Lines of the document read last, to be edited, when editable
+        self.editable = editable
+        self._source = None
+        # Regions of that document, and the lines of every region
+        self._regions = self._region_lines = None
         # Section with key None is the documentation section
-        self.chunks = {None: Chunk(syntax="text", lines=[], position=0)}
+        self.chunks = {None: Chunk(syntax="text", position=0,
+            lines=LazyLines(self, None) if lazy else self._new_lines())}
         self.last_fname = None
         self.encoding = encoding
+        # Every file read, included ones too, with its size and mtime
+        self.files = []
+        # Definitions replaced by later ones of the same name
+        self._replaced = []
+        # Files whose chunks were included, and the chain being included
+        self.includes = set()
+        self._including = []
+        # Cache of expanded chunks, keyed by (chunk name, indentation)
+        self._expanded = {}
+        # Cache of chunk digests, keyed by chunk name
+        self._digests = {}
+        # Cache of the chunks referenced by every chunk
+        self._chunk_references = None
 
         if file is not None:
             self.read(file)
 
     def read(self, file):
         if isinstance(file, basestring):
-            input = open(file)
+            input = open(file, 'rb')
             self.last_fname = file
         else:
             input = file
             self.last_fname = None
+        self._expanded = {}
+        self._digests = {}
+        self._chunk_references = None
+        start = timer() if self.hooks or self.global_hooks else None
+        lines = size = None
         try:
-            chunkName = None
-
-            for lnum, line in enumerate(input):
-                if self.encoding:
-                    line = line.decode(self.encoding)
-                if lnum == 0:
-                    match = self.firstline_re.match(line)
-                    if match:
-                        options = match.groupdict()
-                        encoding = options["encoding"]
-                        if encoding:
-                            self.encoding = encoding
-                        syntax = options["syntax"]
-                        if syntax:
-                            self.chunks[None] = self.chunks[None]._replace(syntax=syntax)
-                        continue
-                match = self.chunk_def.match(line)
+            if isinstance(file, basestring):
+                stamp = _file_stamp(file)
+                self.files.append((file, stamp))
+                size = stamp[0] if stamp else None
+            if self.editable:
+                self._unindex()
+                self._source = list(input)
+                lines = self._read_lines(self._source, fname=self.last_fname)
+            elif self.lazy and isinstance(file, basestring):
+                self._scan(input, file)
+            else:
+                lines = self._read_lines(input, fname=self.last_fname)
+        finally:
+            if isinstance(file, basestring):
+                input.close()
+            if self.compact:
+                self._text.freeze()
+        if self.editable:
+            self._index_regions()
+        if start is not None:
+            self._notify('read', timer() - start, lines=lines, bytes=size,
+                chunks=len(self.chunks) - 1)
+
+    def _read_lines(self, input, lnum=0, chunkName=None, lines=None,
+            fname=None):
+        chunks = self.chunks
+        if lines is None:
+            lines = chunks[None].lines
+        docLines = chunks[None].lines if chunkName else lines
+        chunk_def = self.chunk_def.match
+        chunk_end = self.chunk_end.match
+        chunk_invocation = self.chunk_invocation.match
+        include = self.include_re.match
+
+        for lnum, line in enumerate(input, lnum + 1):
+            if isinstance(line, bytes):
+                line = line.decode(self.encoding or 'utf-8')
+            if lnum == 1:
+                match = self.firstline_re.match(line)
+                if match:
+                    options = match.groupdict()
+                    encoding = options["encoding"]
+                    if encoding:
+                        self.encoding = encoding
+                    syntax = options["syntax"]
+                    if syntax:
+                        chunks[None] = chunks[None]._replace(syntax=syntax)
+                    continue
+
+            first = line[:1]
+            if first == '<':
+                match = chunk_def(line)
                 if match and not chunkName:
                     chunkName = match.group('name')
-                    chunkSyntax = match.group('syntax')
                     # Append reference to code in documentation
-                    self.chunks[None].lines.append(Line(type=Line.CHUNK_BEGIN,
-                        value=chunkName, indentation="", position=lnum + 1))
+                    docLines.append(Line(Line.CHUNK_BEGIN, chunkName, "", lnum,
+                        fname))
                     # Store code chunk
-                    self.chunks[chunkName] = Chunk(syntax=chunkSyntax, lines=[],
-                        position=lnum + 1)
-                else:
-                    match = self.chunk_end.match(line)
+                    lines = self._new_lines()
+                    if chunkName in chunks:
+                        self._replaced.append(chunks[chunkName])
+                    chunks[chunkName] = Chunk(match.group('syntax'), lines, lnum,
+                        fname)
+                    continue
+            elif first == '@':
+                match = chunk_end(line)
+                if match:
+                    chunkName = None
+                    lines = docLines
+                    text = match.group('text')
+                    if text:
+                        lines.append(Line(Line.DOCUMENTATION, text, "", lnum, fname))
+                    continue
+                if not chunkName:
+                    match = include(line)
                     if match:
-                        chunkName = None
-                        text = match.group('text')
-                        if text:
-                            self.chunks[chunkName].lines.append(Line(
-                                type=Line.DOCUMENTATION,
-                                value=text, indentation="", position=lnum + 1))
-                    else:
-                        line = self.chunk_at.sub('@', line)
-                        match = self.chunk_invocation.match(line)
-                        if match:
-                            sub_chunk = match.group('name')
-                            sub_indent = match.group('indent')
-                            self.chunks[chunkName].lines.append(Line(type=Line.REFERENCE,
-                                value=sub_chunk, indentation=sub_indent, position=lnum + 1))
-                        else:
-                            self.chunks[chunkName].lines.append(Line(
-                                type=Line.CODE if chunkName else Line.DOCUMENTATION,
-                                value=line, indentation="", position=lnum + 1))
-        finally:
-            if isinstance(file, basestring):
-                input.close()
+                        self.include(match.group('path'),
+                            Line(Line.DOCUMENTATION, line, "", lnum, fname))
+                        continue
+                line = self.chunk_at.sub('@', line)
+
+            if '<<' in line:
+                match = chunk_invocation(line)
+                if match:
+                    lines.append(Line(Line.REFERENCE, match.group('name'),
+                        match.group('indent'), lnum, fname))
+                    continue
+            lines.append(Line(Line.CODE if chunkName else Line.DOCUMENTATION,
+                line, "", lnum, fname))
+        return lnum
+
+    include_re = re.compile(r'^@include\s+(?P<path>.*?)\s*$')
+
+    # Included documents shared by every reader, with the readers' options
+    _included = {}
+
+    def include(self, path, line=None):
+        """Add the chunks of the document at path to the chunks of this one.
+
+        line is the @include line, if any, the path being relative to its file.
+        """
+        if line is not None and line.file and not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(line.file), path)
+        key = (os.path.abspath(path), self.encoding, self.compact, self.lazy)
+        including = self._including or ([os.path.abspath(self.last_fname)]
+            if self.last_fname else [])
+        if key[0] in including:
+            cycle = including[including.index(key[0]):] + [key[0]]
+            raise DocumentError("%s: cyclic @include (%s)" % (
+                self._err_pos(line) if line is not None else path,
+                " -> ".join(os.path.relpath(fname) for fname in cycle)))
+
+        doc = self._included.get(key)
+        if doc is None or doc.changed():
+            doc = Reader(encoding=self.encoding, compact=self.compact,
+                lazy=self.lazy)
+            doc._including = including + [key[0]]
+            doc.read(path)
+            self._included[key] = doc
+
+        for name, chunk in doc.chunks.items():
+            if name is not None:
+                self.chunks[name] = chunk
+        for entry in doc.files:
+            if entry not in self.files:
+                self.files.append(entry)
+        self.includes.update(fname for fname, stamp in doc.files)
+        self._expanded = {}
+        self._digests = {}
+        self._chunk_references = None
+
+    def changed(self):
+        """Tell whether any file read by this reader changed since."""
+        return any(_file_stamp(fname) != stamp for fname, stamp in self.files)
+
+    lazy_candidate = re.compile(br'\n[<@][^\n]*')
+
+    def _candidates(self, data, pos):
+        """Yield the spans of the lines from pos on that start with < or @."""
+        if pos == 0 and data[:1] in (b'<', b'@'):
+            yield 0, data.find(b'\n') + 1 or len(data)
+        # The newline ending a line is left for the next one to match
+        size = len(data)
+        for match in self.lazy_candidate.finditer(data, max(pos - 1, 0)):
+            yield match.start() + 1, min(match.end() + 1, size)
+
+    def _scan(self, input, fname):
+        import mmap
+        size = os.fstat(input.fileno()).st_size
+        data = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ) \
+            if size else b''
+        chunks = self.chunks
+        docLines = chunks[None].lines
+
+        # The first line may hold the options of the document
+        pos = lnum = 0
+        end = data.find(b'\n') + 1 or len(data)
+        if data:
+            match = self.firstline_re.match(
+                data[:end].decode(self.encoding or 'utf-8'))
+            if match:
+                options = match.groupdict()
+                if options["encoding"]:
+                    self.encoding = options["encoding"]
+                if options["syntax"]:
+                    chunks[None] = chunks[None]._replace(
+                        syntax=options["syntax"])
+                pos, lnum = end, 1
+
+        chunkName = None
+        start, startLnum = pos, lnum
+        for begin, end in self._candidates(data, pos):
+            lnum += data[pos:begin].count(b'\n')
+            pos = begin
+            line = data[begin:end].decode(self.encoding or 'utf-8')
+            if chunkName is None:
+                match = self.chunk_def.match(line)
+                if match:
+                    docLines.add(data, start, pos, startLnum, fname)
+                    chunkName = match.group('name')
+                    docLines.append(Line(Line.CHUNK_BEGIN, chunkName, "",
+                        lnum + 1, fname))
+                    if chunkName in chunks:
+                        self._replaced.append(chunks[chunkName])
+                    chunks[chunkName] = Chunk(match.group('syntax'),
+                        LazyLines(self, chunkName), lnum + 1, fname)
+                    start, startLnum = end, lnum + 1
+                    continue
+                match = self.include_re.match(line)
+                if match:
+                    docLines.add(data, start, pos, startLnum, fname)
+                    self.include(match.group('path'),
+                        Line(Line.DOCUMENTATION, line, "", lnum + 1, fname))
+                    start, startLnum = end, lnum + 1
+            elif self.chunk_end.match(line):
+                chunks[chunkName].lines.add(data, start, pos, startLnum, fname)
+                chunkName = None
+                start, startLnum = pos, lnum
+        chunks[chunkName].lines.add(data, start, len(data), startLnum, fname)
+
+    def edit(self, start, end, text):
+        """Replace lines start to end, end excluded, by the lines of text.
+
+        Lines are counted from 1, like positions. Returns whether the edit was
+        parsed by itself, rather than by parsing the whole document again.
+        """
+        source = self._source
+        if source is None:
+            raise ValueError("Only a reader created with editable=True can be "
+                "edited")
+        if not 1 <= start <= end <= len(source) + 1:
+            raise ValueError("No lines %d to %d in a document of %d lines" % (
+                start, end - 1, len(source)))
+        began = timer() if self.hooks or self.global_hooks else None
+        if isinstance(text, bytes):
+            text = text.decode(self.encoding or 'utf-8')
+        new = io.StringIO(text).readlines()
+        if new and end <= len(source) and not new[-1].endswith('\n'):
+            new[-1] += '\n'
+
+        incremental = self._edit_lines(start, end, new)
+        source[start - 1:end - 1] = new
+        if not incremental:
+            self._parse_source()
+        self._expanded = {}
+        self._digests = {}
+        if began is not None:
+            self._notify('edit', timer() - began,
+                lines=len(new) if incremental else len(source))
+        return incremental
+
+    def _edit_lines(self, start, end, new):
+        """Parse new in place of lines start to end, unless a chunk starts or
+        ends there. Returns whether it did."""
+        boundary = self._boundary
+        regions = self._regions
+        if regions is None or start == 1 or any(boundary(line)
+                for line in chain(self._source[start - 1:end - 1], new)):
+            return False
+
+        # The new lines go where line start - 1 is, which is the code of a chunk
+        # when it defines one
+        region = regions.find(start - 1)
+        if region % 2 == 0 and region + 1 < regions.size \
+                and start == regions.start(region + 1):
+            region += 1
+        lines, segment, name = self._region_lines[region]
+        if name is not None:
+            chunk = self.chunks.get(name)
+            if chunk is None or chunk.lines is not lines:
+                # A definition replaced by a later one
+                return False
+
+        parsed = []
+        self._read_lines(new, start - 1, name, parsed, self.last_fname)
+        delta = len(new) - (end - start)
+        old = lines.edit(segment, start, end, parsed, delta)
+        if delta:
+            regions.resize(region, delta)
+        referencing = name is not None and any(line.type == Line.REFERENCE
+            for line in chain(old, parsed))
+        if referencing and self._chunk_references is not None:
+            self._chunk_references[name] = set(line.value for line in lines
+                if line.type == Line.REFERENCE)
+        return True
+
+    def _boundary(self, line):
+        """Tell whether line may start or end a chunk, or include a document."""
+        if isinstance(line, bytes):
+            line = line.decode(self.encoding or 'utf-8')
+        first = line[:1]
+        return first == '<' and self.chunk_def.match(line) is not None \
+            or first == '@' and (self.chunk_end.match(line) is not None
+                or self.include_re.match(line) is not None)
+
+    @property
+    def replaced(self):
+        """Definitions replaced by later ones of the same name."""
+        if self._regions is None:
+            return self._replaced
+        return [_shifted_chunk(chunk) for chunk in self._replaced]
+
+    def _index_regions(self):
+        """Split the document just read into regions, so that edits move their
+        lines without renumbering them."""
+        fname = self.last_fname
+        definitions = dict((chunk.position, chunk)
+            for chunk in chain(self.chunks.values(), self._replaced)
+            if chunk.position and chunk.file == fname)
+        lengths, segments, begins = [], [[]], []
+        end = previous = 0
+        for line in self.chunks[None].lines:
+            if line.file != fname or line.position <= previous:
+                # The lines of documents read before
+                return
+            previous = line.position
+            segments[-1].append(line)
+            if line.type == Line.CHUNK_BEGIN:
+                chunk = definitions.get(line.position)
+                if chunk is None:
+                    # A definition replaced by an included document
+                    return
+                lengths.extend([line.position - end, len(chunk.lines)])
+                end = line.position + len(chunk.lines)
+                begins.append(line)
+                segments.append([])
+        lengths.append(len(self._source) - end)
+
+        regions = Regions(lengths)
+        documentation = ShiftedLines(regions,
+            [(2 * index, lines) for index, lines in enumerate(segments)])
+        region_lines = [(documentation, 0, None)]
+        bodies = {}
+        for index, begin in enumerate(begins):
+            body = bodies[begin.position] = ShiftedLines(regions,
+                [(2 * index + 1, definitions[begin.position].lines)])
+            region_lines.extend([(body, 0, begin.value),
+                (documentation, index + 1, None)])
+
+        def shifting(chunk):
+            if chunk.file != fname or chunk.position not in bodies:
+                return chunk
+            return chunk._replace(lines=bodies[chunk.position])
+        chunks = ShiftedChunks((name, shifting(chunk))
+            for name, chunk in self.chunks.items())
+        chunks[None] = self.chunks[None]._replace(lines=documentation)
+        self.chunks = chunks
+        self._replaced = [shifting(chunk) for chunk in self._replaced]
+        self._regions = regions
+        self._region_lines = region_lines
+
+    def _unindex(self):
+        """Give the chunks plain lists of lines again, before reading."""
+        if self._regions is None:
+            return
+        self._replaced = [chunk._replace(lines=list(chunk.lines))
+            for chunk in self.replaced]
+        self.chunks = dict((name, chunk._replace(lines=list(chunk.lines)))
+            for name, chunk in self.chunks.items())
+        self._regions = self._region_lines = None
+
+    def _parse_source(self):
+        """Parse the lines of the document again, from scratch."""
+        self.chunks = {None: Chunk(syntax="text", position=0, lines=[])}
+        self._replaced = []
+        self._regions = self._region_lines = None
+        self._chunk_references = None
+        self._read_lines(self._source, fname=self.last_fname)
+        self._index_regions()
+
+    def _new_lines(self):
+        return LineArray(self._text) if self.compact else []
 
     def _indent_line(self, line, indent):
         return line if line.value in ('', '\n', '\r\n') \
@@ -326,27 +1732,343 @@ class Reader(object):
 
     def tangle(self, chunkName, indent=""):
         if chunkName not in self.chunks:
-            raise ValueError("No such chunk in document '%s'" % (chunkName,))
-
+            raise DocumentError("No such chunk in document '%s'" % (chunkName,))
+
+        if not (self.hooks or self.global_hooks):
+            return list(self._expand(chunkName, indent, []))
+        start = timer()
+        lines = list(self._expand(chunkName, indent, []))
+        self._notify('tangle', timer() - start, chunk=chunkName, lines=len(lines))
+        return lines
+
+    def _expand(self, chunkName, indent, active):
+        key = (chunkName, indent)
+        if key in self._expanded:
+            return self._expanded[key]
+
+        active.append(chunkName)
+        expanded = []
         for line in self.chunks[chunkName].lines:
             if line.type == Line.REFERENCE:
                 assert(chunkName != None)
                 if line.value not in self.chunks:
-                    err_pos = ''
-                    if self.last_fname:
-                        err_pos = self.last_fname + ':'
-                    err_pos += '%u' % (line.position,)
-                    raise RuntimeError(
-                        "%s: reference to non-existent chunk '%s'" % (err_pos, line.value))
-                for line in self.tangle(line.value, indent + line.indentation):
-                    yield line
+                    raise DocumentError(
+                        "%s: reference to non-existent chunk '%s'" % (
+                            self._err_pos(line), line.value))
+                if line.value in active:
+                    cycle = active[active.index(line.value):] + [line.value]
+                    raise DocumentError(
+                        "%s: cyclic reference to chunk '%s' (%s)" % (
+                            self._err_pos(line), line.value,
+                            " -> ".join(cycle)))
+                expanded.extend(self._expand(line.value,
+                    indent + line.indentation, active))
             else:
-                yield self._indent_line(line, indent)
+                expanded.append(self._indent_line(line, indent))
+        if self.hooks or self.global_hooks:
+            self._notify('expand', None, chunk=chunkName, lines=len(expanded),
+                depth=len(active))
+        active.pop()
+
+        self._expanded[key] = expanded
+        return expanded
+
+    def _err_pos(self, line):
+        err_pos = ''
+        fname = line.file or self.last_fname
+        if fname:
+            err_pos = fname + ':'
+        err_pos += '%u' % (line.position,)
+        return err_pos
+
+    file_name_re = re.compile(r'^[^\s]*[./][^\s]*$')
+
+    def roots(self, references=None):
+        """Return the names of the root chunks in document order."""
+        if references is None:
+            references = self._references()
+        referenced = set()
+        for names in references.values():
+            referenced.update(names)
+
+        roots = [name for name in self.chunks if name is not None
+            and self.chunks[name].file not in self.includes
+            and (name not in referenced or self.file_name_re.match(name))]
+        return sorted(roots, key=lambda name: self.chunks[name].position)
+
+    def tangle_all(self, directory=os.curdir, atomic=False,
+            line_directives=None, source_map=False):
+        """Write every root chunk below directory and return the written paths."""
+        paths = []
+        targets = [(name, self.root_path(directory, name))
+            for name in self.roots()]
+        for name, path in targets:
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            smap = SourceMap(path) if source_map else None
+            self.write(self.tangled(name, line_directives, smap), path, atomic)
+            if smap is not None:
+                smap.save(path + '.map', atomic)
+            paths.append(path)
+        return paths
+
+    def root_path(self, directory, name):
+        """Return the path the root chunk name is written to below directory."""
+        if os.path.isabs(name) or os.path.splitdrive(name)[0] \
+                or '..' in re.split(r'[\\/]', name):
+            raise DocumentError("%s: root chunk '%s' would be written outside "
+                "of '%s'" % (self._err_pos(self.chunks[name]), name, directory))
+        return os.path.join(directory, name)
+
+    def _references(self):
+        """Map every chunk to the set of chunks it references."""
+        references = self._chunk_references
+        if references is None:
+            references = self._chunk_references = {}
+            for name, chunk in self.chunks.items():
+                if name is not None:
+                    references[name] = set(line.value for line in chunk.lines
+                        if line.type == Line.REFERENCE)
+        return references
+
+    def users(self, references=None):
+        """Map every chunk to the chunks referencing it, in document order."""
+        if references is None:
+            references = self._references()
+        users = dict((name, []) for name in references)
+        for name in sorted(references, key=lambda name:
+                (self.chunks[name].file or '', self.chunks[name].position)):
+            for reference in references[name]:
+                users.setdefault(reference, []).append(name)
+        return users
+
+    def dependencies(self, names=None):
+        """Map root chunks, or the given ones, to the chunks they include.
+
+        The chunks included by a chunk, the chunk itself among them, are listed
+        in document order. References to missing chunks are left out.
+        """
+        references = self._references()
+        if names is None:
+            names = self.roots(references)
+        dependencies = {}
+        for name in names:
+            if name not in references:
+                raise DocumentError("No such chunk in document '%s'" % (name,))
+            included = set([name])
+            pending = [name]
+            while pending:
+                for reference in references.get(pending.pop(), ()):
+                    if reference not in included and reference in references:
+                        included.add(reference)
+                        pending.append(reference)
+            dependencies[name] = sorted(included,
+                key=lambda name: self.chunks[name].position)
+        return dependencies
+
+    def line_range(self, chunkName):
+        """Return the first and last line of a chunk in its document."""
+        chunk = self.chunks[chunkName]
+        last = chunk.position
+        for line in chunk.lines:
+            last = line.position
+        return chunk.position, last
+
+    def check(self, roots=()):
+        """Return the problems found in the chunks of the document.
+
+        Every problem is a message starting with the file and line it is at, and
+        they are sorted by those. roots are chunks not to report as unused.
+        """
+        problems = []
+        def report(where, message):
+            problems.append((where.file or self.last_fname or '', where.position,
+                "%s: %s" % (self._err_pos(where), message)))
+
+        definitions = {}
+        for line in self.chunks[None].lines:
+            if line.type == Line.CHUNK_BEGIN:
+                if line.value in definitions:
+                    report(line, "chunk '%s' is defined again, replacing the "
+                        "definition at %s" % (line.value,
+                            self._err_pos(definitions[line.value])))
+                definitions[line.value] = line
+
+        uses = {}
+        used = set(roots)
+        for name, chunk in self.chunks.items():
+            if name is None:
+                continue
+            uses[name] = [line for line in chunk.lines
+                if line.type == Line.REFERENCE]
+            for line in uses[name]:
+                used.add(line.value)
+                if line.value not in self.chunks:
+                    report(line, "reference to non-existent chunk '%s'" % (
+                        line.value,))
+
+        for chunk in self.replaced:
+            for line in chunk.lines:
+                if line.type == Line.REFERENCE and line.value not in self.chunks:
+                    report(line, "reference to non-existent chunk '%s'" % (
+                        line.value,))
+
+        order = sorted(uses, key=lambda name:
+            (self.chunks[name].file or '', self.chunks[name].position))
+        for name in order:
+            chunk = self.chunks[name]
+            if name not in used and chunk.file not in self.includes \
+                    and not self.file_name_re.match(name):
+                report(chunk, "chunk '%s' is never used" % (name,))
+
+        # Chunks being searched are True, those searched already False
+        active = {}
+        for name in order:
+            if name in active:
+                continue
+            active[name] = True
+            path = [name]
+            pending = [iter(uses[name])]
+            while pending:
+                for line in pending[-1]:
+                    if line.value not in uses:
+                        continue
+                    if active.get(line.value):
+                        cycle = path[path.index(line.value):] + [line.value]
+                        report(line, "cyclic reference to chunk '%s' (%s)" % (
+                            line.value, " -> ".join(cycle)))
+                    elif line.value not in active:
+                        active[line.value] = True
+                        path.append(line.value)
+                        pending.append(iter(uses[line.value]))
+                        break
+                else:
+                    active[path.pop()] = False
+                    pending.pop()
+
+        return [message for fname, position, message in sorted(problems)]
 
-    def weave(self, default_code_syntax=None, indent="", **kwargs):
+    LINE_DIRECTIVE = '#line %(line)d "%(file)s"'
 
-        formatter = self.formatters.get(self.chunks[None].syntax)
+    def line_directives(self, lines, template=LINE_DIRECTIVE):
+        """Yield lines with a line directive wherever their origin jumps."""
+        template += '\n'
+        expected = None
+        newline = True
+        for line in lines:
+            fname = line.file or self.last_fname or '-'
+            if (fname, line.position) != expected:
+                directive = template % dict(line=line.position, file=fname)
+                yield Line(Line.CODE, directive if newline else '\n' + directive,
+                    "", 0)
+            expected = (fname, line.position + 1)
+            newline = line.value.endswith('\n')
+            yield line
+
+    def tangled(self, chunkName, line_directives=None, source_map=None):
+        """Tangle a chunk, adding line directives and tracking a source map."""
+        lines = self.tangle(chunkName)
+        if line_directives:
+            lines = self.line_directives(lines, line_directives)
+        if source_map is not None:
+            lines = source_map.track(lines)
+        return lines
+
+    global_hooks = []
+
+    def _notify(self, event, seconds, **info):
+        for hook in chain(self.global_hooks, self.hooks):
+            hook(event, seconds, info)
+
+    def _timed(self, event, fragments):
+        """Yield fragments, reporting the time it took to produce them."""
+        elapsed = 0.0
+        count = 0
+        fragments = iter(fragments)
+        while True:
+            start = timer()
+            try:
+                fragment = next(fragments)
+            except StopIteration:
+                break
+            elapsed += timer() - start
+            count += 1
+            yield fragment
+        self._notify(event, elapsed, fragments=count)
+
+    def _timed_output(self, data):
+        """Yield data, reporting the time its consumer spent writing it."""
+        elapsed = 0.0
+        size = 0
+        for block in data:
+            size += len(block)
+            start = timer()
+            yield block
+            elapsed += timer() - start
+        self._notify('write', elapsed, bytes=size)
+
+    def digest(self, chunkName):
+        """Return a hash of a chunk and of every chunk it references."""
+        if chunkName in self._digests:
+            return self._digests[chunkName]
+
+        import hashlib
+        # A cyclic reference hashes as an empty string, tangle reports it
+        self._digests[chunkName] = ''
+        h = hashlib.sha1()
+        for line in self.chunks[chunkName].lines:
+            if line.type == Line.REFERENCE and line.value in self.chunks:
+                value = self.digest(line.value)
+            else:
+                value = line.value
+            h.update(("%d %s%s\0" % (line.type, line.indentation, value)
+                ).encode('utf-8'))
+        self._digests[chunkName] = h.hexdigest()
+        return self._digests[chunkName]
+
+    def weave(self, default_code_syntax=None, indent="", format=None, **kwargs):
+        fragments = self._weave(default_code_syntax, indent, format, **kwargs)
+        hooked = self.hooks or self.global_hooks
+        return self._timed('weave', fragments) if hooked else fragments
+
+    def _weave(self, default_code_syntax, indent, format, **kwargs):
+        formatter = find_formatter(format or self.chunks[None].syntax)
+        if not isinstance(formatter, type):
+            for line in self._weave_lines(formatter, default_code_syntax, indent,
+                    **kwargs):
+                yield line
+            return
 
+        formatter = formatter(self, **kwargs)
+        for fragment in formatter.begin():
+            yield fragment
+
+        documentation = []
+        for line in self.chunks[None].lines:
+            if line.type != Line.CHUNK_BEGIN:
+                documentation.append(self._indent_line(line, indent) if indent
+                    else line)
+                continue
+            if documentation:
+                for fragment in formatter.documentation(documentation):
+                    yield fragment
+                documentation = []
+            chunk = self.chunks[line.value]
+            for fragment in formatter.chunk(line.value, chunk.lines,
+                    chunk.syntax or default_code_syntax):
+                yield fragment
+        if documentation:
+            for fragment in formatter.documentation(documentation):
+                yield fragment
+
+        for fragment in formatter.end():
+            yield fragment
+
+    def _weave_lines(self, formatter, default_code_syntax, indent, **kwargs):
+        import warnings
+        warnings.warn("Formatter functions are deprecated, use a Formatter "
+            "subclass", DeprecationWarning)
         for line in self.chunks[None].lines:
             if line.type == Line.CHUNK_BEGIN:
                 syntax = self.chunks[line.value].syntax or default_code_syntax
@@ -365,124 +2087,1246 @@ class Reader(object):
                 for formatted_line in formatter(self, line, None, **kwargs):
                     yield formatted_line
 
+    def format_markdown(self, lines, code_syntax, add_links=False, **options):
+        """Yield a line or some lines woven into Markdown, as lines.
 
-    def format_markdown(self, lines, code_syntax, add_links):
+        Deprecated: weave uses MarkdownFormatter.
+        """
         if isinstance(lines, Line):
             lines = [lines]
+        formatter = MarkdownFormatter(self)
+        # Only the anchors are wanted, the chunks' references aren't looked for
+        formatter.add_links = add_links
 
         for line in lines:
             if line.type == Line.CHUNK_BEGIN:
-                # Add a heading with the chunk's name.
-                yield line._replace(value="\n")
-                yield line._replace(value='###### ')
-                yield line
-                if add_links:
-                    name = "-".join(line.value.split()).lower()
-                    yield line._replace(value="".join([' <a name="', name, '"></a>']))
-                yield line._replace(value="\n")
-                yield line._replace(value="\n")
-
-                if code_syntax:
-                    yield line._replace(value="```%s\n" % (code_syntax,))
-
+                yield line._replace(value=formatter.chunk_heading(line.value,
+                    code_syntax))
             elif line.type == Line.CHUNK_END:
                 yield line._replace(value='```\n' if code_syntax else "\n")
-
             elif line.type == Line.CODE:
-                if not code_syntax:
-                    yield self._indent_line(line, "    ")
-                else:
-                    yield line
-
+                yield line if code_syntax else self._indent_line(line, "    ")
             elif line.type == Line.REFERENCE:
                 yield line._replace(value="".join(["<<", line.value, ">>", "\n"]))
-
             elif line.type == Line.DOCUMENTATION:
-                assert(code_syntax == None)
                 yield line
-
             else:
                 raise TypeError("Unknown type of line")
 
     formatters = {
-        "markdown": format_markdown,
-        "mdown":    format_markdown,
-        "md":       format_markdown,
+        "markdown": MarkdownFormatter,
+        "mdown":    MarkdownFormatter,
+        "md":       MarkdownFormatter,
 
-        "text":     format_markdown,
-        "txt":      format_markdown,
-        None:       format_markdown,
+        "text":     MarkdownFormatter,
+        "txt":      MarkdownFormatter,
+        None:       MarkdownFormatter,
+
+        "html":     HtmlFormatter,
+        "htm":      HtmlFormatter,
+
+        "latex":    LatexFormatter,
+        "tex":      LatexFormatter,
     }
 
+    write_batch = 4096
+    write_buffering = 1 << 16
 
-    def write(self, lines, file=None):
-        if isinstance(file, basestring) or file is None:
-            outfile = StringIO()
+    def _encode(self, lines):
+        """Yield the text of lines, joined and encoded a batch at a time."""
+        encoding = self.encoding or 'utf-8'
+        lines = iter(lines)
+        first = next(lines, None)
+        if first is None:
+            return
+        lines = chain([first], lines)
+        fragments = isinstance(first, basestring)
+        while True:
+            if fragments:
+                batch = list(islice(lines, self.write_batch))
+            else:
+                batch = [text for line in islice(lines, self.write_batch)
+                    for text in (line.indentation, line.value)]
+            if not batch:
+                return
+            yield "".join(batch).encode(encoding)
+
+    def write(self, lines, file=None, atomic=False):
+        output = self._encode(lines)
+        if self.hooks or self.global_hooks:
+            output = self._timed_output(output)
+        if file is None:
+            return b"".join(output)
+        if not isinstance(file, basestring):
+            for data in output:
+                file.write(data)
+            return
+
+        path = '%s.%d.tmp' % (file, os.getpid()) if atomic else file
+        try:
+            with open(path, 'wb', self.write_buffering) as f:
+                for data in output:
+                    f.write(data)
+            if atomic:
+                _replace_file(path, file)
+        except BaseException:
+            if atomic and os.path.exists(path):
+                os.remove(path)
+            raise
+
+
+def find_formatter(name):
+    """Return the formatter class of the format called name."""
+    try:
+        return Reader.formatters[name]
+    except KeyError:
+        pass
+    for entry_point in _entry_points('noweb.formatters'):
+        if entry_point.name == name:
+            Reader.formatters[name] = entry_point.load()
+            return Reader.formatters[name]
+    raise ValueError("Unknown weave format: %s" % (name,))
+
+def _entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        return pkg_resources.iter_entry_points(group)
+    try:
+        return entry_points(group=group)
+    except TypeError:
+        # Before Python 3.10 every group is returned at once
+        return entry_points().get(group, [])
+
+
+def expand_inputs(patterns):
+    """Expand directories and glob patterns into a list of input files."""
+    import glob
+    inputs = []
+    seen = set()
+    for pattern in patterns:
+        if pattern == '-':
+            found = [pattern]
+        elif os.path.isdir(pattern):
+            found = []
+            for dirpath, dirnames, filenames in os.walk(pattern):
+                dirnames.sort()
+                found.extend(os.path.join(dirpath, filename)
+                    for filename in sorted(filenames)
+                    if filename.endswith('.nw'))
+        else:
+            found = sorted(glob.glob(pattern)) or [pattern]
+        for input in found:
+            if input not in seen:
+                seen.add(input)
+                inputs.append(input)
+    return inputs
+
+
+def process_file(input, output, encoding='utf-8', chunk=None,
+        tangle_all=False, lazy=False, atomic=False, line_directives=None,
+        source_map=False, **kwargs):
+    """Read a single document, tangle or weave it to output and return the
+    paths written."""
+    doc = Reader(encoding=encoding, lazy=lazy)
+    doc.read(getattr(sys.stdin, 'buffer', sys.stdin) if input == '-'
+        else input)
+    if tangle_all:
+        return doc.tangle_all(os.curdir if output == '-' else output, atomic,
+            line_directives, source_map)
+
+    smap = SourceMap(output) if source_map and output != '-' else None
+    if output == '-':
+        output = getattr(sys.stdout, 'buffer', sys.stdout)
+
+    # If chunk is None -> Weaver mode
+    if chunk:
+        lines = doc.tangled(chunk, line_directives, smap)
+    else:
+        lines = doc.weave(**kwargs)
+    doc.write(lines, output, atomic)
+    if smap is not None:
+        smap.save(smap.output + '.map', atomic)
+    return [] if input == '-' or not isinstance(output, basestring) \
+        else [output]
+
+def _process_job(job):
+    input, output, options, record, stats = job
+    if stats:
+        stats = Stats()
+        Reader.global_hooks.append(stats)
+    try:
+        if record is None:
+            process_file(input, output, **options)
         else:
-            outfile = file
+            record = update_file(input, output, record, **options)
+    except Exception as e:
+        return "%s: %s" % (input, e), None, stats
+    finally:
+        if stats:
+            Reader.global_hooks.remove(stats)
+    return None, record, stats
+
+def _job_targets(job):
+    """Return the paths the roots of a tangle --all job go to."""
+    input, output, options, record, stats = job
+    if stats:
+        stats = Stats()
+        Reader.global_hooks.append(stats)
+    try:
+        recorded = (record or {}).get('options', {})
+        if recorded.get('tangle_all') and recorded.get('output') == output \
+                and record.get('source') == file_digest(input) \
+                and _is_unchanged(record.get('includes', {})):
+            return list(record.get('outputs', ())), stats
+        doc = Reader(encoding=options.get('encoding', 'utf-8'))
+        doc.read(input)
+        directory = os.curdir if output == '-' else output
+        return [doc.root_path(directory, name) for name in doc.roots()], stats
+    except Exception:
+        # Reported when the job is run
+        return [], stats
+    finally:
+        if stats:
+            Reader.global_hooks.remove(stats)
+
+def process_files(jobs, workers=1, manifest=None, stats=None):
+    """Process (input, output, options) jobs using up to workers processes.
+
+    All the jobs are run even if some of them fail. The error messages of the
+    failed ones are returned, or, without running any job, those of the files
+    that several tangle_all jobs would write. When a manifest is given the documents are
+    updated incrementally and the manifest is updated to match. What the
+    worker processes report is added to stats, a hooked `Stats`, if it's
+    given.
+    """
+    documents = None
+    if manifest is not None:
+        documents = manifest['documents']
+    parallel = workers != 1 and len(jobs) > 1
+    jobs = [(input, output, options,
+        None if documents is None else documents.get(input, {}),
+        parallel and stats is not None)
+        for input, output, options in jobs]
+
+    tangling = [job for job in jobs if job[2].get('tangle_all')]
+    if len(tangling) > 1:
+        if parallel:
+            targets = _map_processes(_job_targets, tangling, workers)
+        else:
+            targets = [_job_targets(job) for job in tangling]
+        writers = {}
+        for job, (paths, collected) in zip(tangling, targets):
+            if collected:
+                stats.merge(collected)
+            for path in paths:
+                writers.setdefault(os.path.normpath(path), []).append(job[0])
+        collisions = ["%s: written by each of %s" % (path, ", ".join(inputs))
+            for path, inputs in sorted(writers.items()) if len(inputs) > 1]
+        if collisions:
+            return collisions
+
+    if parallel:
+        results = _map_processes(_process_job, jobs, workers)
+    else:
+        results = [_process_job(job) for job in jobs]
+
+    errors = []
+    for job, (error, record, collected) in zip(jobs, results):
+        if collected:
+            stats.merge(collected)
+        if error is not None:
+            errors.append(error)
+        elif documents is not None:
+            documents[job[0]] = record
+    return errors
+
+def _map_processes(func, items, workers):
+    """Return func applied to items by a pool of worker processes."""
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, items))
+
+
+MANIFEST_VERSION = 1
+
+def load_manifest(path):
+    """Load a manifest, or return an empty one if it doesn't exist yet or
+    can't be parsed."""
+    import json
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = None
+    if not isinstance(manifest, dict) \
+            or manifest.get('version') != MANIFEST_VERSION:
+        manifest = {'version': MANIFEST_VERSION, 'documents': {}}
+    return manifest
+
+def save_manifest(path, manifest):
+    import json
+    data = json.dumps(manifest, indent=1, sort_keys=True)
+    _write_bytes(path, data.encode('utf-8'), atomic=True)
+
+def file_digest(path):
+    """Return the SHA-1 hex digest of the contents of a file."""
+    import hashlib
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _file_stamp(path):
+    try:
+        statinfo = os.stat(path)
+    except OSError:
+        return None
+    return [statinfo.st_size, statinfo.st_mtime]
+
+def _is_intact(path, entry):
+    return entry.get('stamp') is not None \
+        and _file_stamp(path) == entry['stamp']
+
+def _is_unchanged(digests):
+    try:
+        return all(file_digest(path) == digest
+            for path, digest in digests.items())
+    except IOError:
+        return False
+
+def _write_if_changed(path, data, entry, atomic=False):
+    """Write data to path unless it already holds it and return its stamp."""
+    import hashlib
+    if entry.get('output') == hashlib.sha1(data).hexdigest() \
+            and _is_intact(path, entry):
+        return entry['stamp']
+    try:
+        with open(path, 'rb') as f:
+            unchanged = f.read() == data
+    except IOError:
+        unchanged = False
+    if not unchanged:
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        _write_bytes(path, data, atomic)
+    return _file_stamp(path)
+
+def _write_bytes(path, data, atomic=False):
+    if atomic:
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            _replace_file(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    else:
+        with open(path, 'wb') as f:
+            f.write(data)
 
+def _replace_file(tmp_path, path):
+    """Rename tmp_path to path, with the permissions path had, if any."""
+    import shutil
+    try:
+        shutil.copymode(path, tmp_path)
+    except OSError:
+        pass
+    replace(tmp_path, path)
+
+def update_file(input, output, record, encoding='utf-8', chunk=None,
+        tangle_all=False, lazy=False, atomic=False, line_directives=None,
+        source_map=False, doc=None, **kwargs):
+    """Like process_file, but only redo the work that changed since record.
+
+    record is what a previous call returned for the same document, or an
+    empty dictionary. The record describing the new state is returned. doc
+    is the document already read from input, if the caller has it.
+    """
+    import hashlib
+    if input == '-' or (output == '-' and not tangle_all):
+        process_file(input, output, encoding, chunk, tangle_all, lazy,
+            atomic, line_directives, source_map, **kwargs)
+        return {}
+
+    options = dict(output=output, encoding=encoding, chunk=chunk,
+        tangle_all=tangle_all, line_directives=line_directives,
+        source_map=source_map, **kwargs)
+    if record.get('options') != options:
+        record = {}
+    source = file_digest(input)
+    outputs = record.get('outputs', {})
+    if record.get('source') == source and outputs \
+            and _is_unchanged(record.get('includes', {})) \
+            and all(_is_intact(path, entry) for path, entry in outputs.items()):
+        return record
+
+    if doc is None:
+        doc = Reader(encoding=encoding, lazy=lazy)
+        doc.read(input)
+    if tangle_all:
+        directory = os.curdir if output == '-' else output
+        targets = [(name, doc.root_path(directory, name))
+            for name in doc.roots()]
+    elif chunk:
+        targets = [(chunk, output)]
+    else:
+        # The woven document depends on the whole source
+        targets = [(None, output)]
+
+    includes = dict((fname, file_digest(fname)) for fname in doc.includes)
+    # Line numbers end up in the output, so every line of the sources counts
+    origins = hashlib.sha1(" ".join([source] + [includes[fname]
+        for fname in sorted(includes)]).encode('utf-8')).hexdigest()
+
+    new_outputs = {}
+    for name, path in targets:
+        entry = outputs.get(path, {})
+        if name is None:
+            digest = source
+        elif line_directives or source_map:
+            digest = origins
+        else:
+            digest = doc.digest(name)
+        if entry.get('digest') != digest or not _is_intact(path, entry):
+            smap = SourceMap(path) if source_map and name else None
+            if name is None:
+                data = doc.write(doc.weave(**kwargs))
+            else:
+                data = doc.write(doc.tangled(name, line_directives, smap))
+            entry = dict(digest=digest, output=hashlib.sha1(data).hexdigest(),
+                stamp=_write_if_changed(path, data, entry, atomic))
+            if smap is not None:
+                _write_if_changed(path + '.map', smap.dumps().encode('utf-8'),
+                    {}, atomic)
+        new_outputs[path] = entry
+    return dict(options=options, source=source, includes=includes,
+        outputs=new_outputs)
+
+
+def document_dependencies(doc, input, directory=os.curdir, chunk=None):
+    """Describe the outputs tangle --all would make of doc, read from input.
+
+    With chunk only that chunk is described, whether it is a root or not.
+    """
+    dependencies = doc.dependencies(None if chunk is None else [chunk])
+    outputs = {}
+    for name, included in dependencies.items():
+        files = set([input])
+        files.update(doc.chunks[dependency].file or input
+            for dependency in included)
+        outputs[os.path.normpath(doc.root_path(directory, name))] = dict(
+            document=input, files=sorted(files), chunk=name,
+            digest=doc.digest(name),
+            chunks=dict((dependency, dict(
+                    file=doc.chunks[dependency].file or input,
+                    lines=list(doc.line_range(dependency))))
+                for dependency in included))
+    return outputs
+
+def _make_escape(path):
+    return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+def format_dependencies(outputs, format='make'):
+    """Return the text of a depfile or JSON file describing outputs."""
+    if format == 'json':
+        import json
+        return json.dumps(outputs, indent=1, sort_keys=True,
+            separators=(',', ': ')) + '\n'
+    rules = ["%s: %s\n" % (_make_escape(path),
+            " ".join(_make_escape(fname) for fname in outputs[path]['files']))
+        for path in sorted(outputs)]
+    rules.extend("\n%s:\n" % (_make_escape(fname),)
+        for fname in sorted(set(fname for output in outputs.values()
+            for fname in output['files'])))
+    return "".join(rules)
+
+
+_BASE64 = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+    '0123456789+/')
+
+def _vlq(value):
+    """Encode an integer as a base64 variable-length quantity."""
+    value = ((-value) << 1) | 1 if value < 0 else value << 1
+    digits = []
+    while True:
+        digit = value & 31
+        value >>= 5
+        digits.append(_BASE64[digit | 32 if value else digit])
+        if not value:
+            return "".join(digits)
+
+class SourceMap(object):
+    """A version 3 source map of an output file, built line by line."""
+
+    def __init__(self, output):
+        self.output = output
+        self.sources = []
+        self._indexes = {}
+        self._mappings = []
+        # Source and line of the previous mapping, mappings are relative
+        self._last = (0, 0)
+
+    def add(self, line):
+        """Map the next line of the output to the origin of line."""
+        if line.file is None or line.position < 1:
+            self._mappings.append("")
+            return
+        index = self._indexes.get(line.file)
+        if index is None:
+            index = self._indexes[line.file] = len(self.sources)
+            self.sources.append(line.file)
+        source, position = index, line.position - 1
+        self._mappings.append("A" + _vlq(source - self._last[0])
+            + _vlq(position - self._last[1]) + "A")
+        self._last = (source, position)
+
+    def track(self, lines):
+        """Yield lines, mapping every one of them on the way."""
         for line in lines:
-            outfile.write(unicode(line).encode(self.encoding))
+            self.add(line)
+            yield line
+
+    def dumps(self):
+        import json
+        directory = os.path.dirname(os.path.abspath(self.output))
+        return json.dumps(dict(version=3,
+            file=os.path.basename(self.output),
+            sources=[os.path.relpath(os.path.abspath(source), directory)
+                for source in self.sources],
+            names=[], mappings=";".join(self._mappings)),
+            sort_keys=True) + '\n'
+
+    def save(self, path, atomic=False):
+        _write_bytes(path, self.dumps().encode('utf-8'), atomic)
+
+
+class Stats(object):
+    """A Reader hook adding up what the readers report."""
+
+    def __init__(self):
+        # Calls and seconds of every phase, totals of its counts
+        self.phases = {}
+        self.totals = {}
+        # Largest expansion of every chunk, in lines
+        self.expansions = {}
+        self.depth = 0
+
+    def __call__(self, event, seconds, info):
+        if event == 'expand':
+            chunk = info['chunk']
+            self.expansions[chunk] = max(self.expansions.get(chunk, 0),
+                info['lines'])
+            self.depth = max(self.depth, info['depth'])
+            return
+        phase = self.phases.setdefault(event, [0, 0.0])
+        phase[0] += 1
+        phase[1] += seconds or 0.0
+        for name, value in info.items():
+            if value is not None and not isinstance(value, basestring):
+                self.totals[event, name] = \
+                    self.totals.get((event, name), 0) + value
+
+    def merge(self, other):
+        """Add up what another Stats collected, in a worker process say."""
+        for event, (calls, seconds) in other.phases.items():
+            phase = self.phases.setdefault(event, [0, 0.0])
+            phase[0] += calls
+            phase[1] += seconds
+        for key, value in other.totals.items():
+            self.totals[key] = self.totals.get(key, 0) + value
+        for chunk, lines in other.expansions.items():
+            self.expansions[chunk] = max(self.expansions.get(chunk, 0), lines)
+        self.depth = max(self.depth, other.depth)
+
+    def report(self, file=sys.stderr, top=10):
+        file.write("%-8s %6s %10s\n" % ("phase", "calls", "seconds"))
+        for event in sorted(self.phases):
+            calls, seconds = self.phases[event]
+            counts = " ".join("%s=%d" % (name, self.totals[event, name])
+                for phase, name in sorted(self.totals) if phase == event)
+            file.write("%-8s %6d %10.4f  %s\n" % (event, calls, seconds,
+                counts))
+        if self.expansions:
+            file.write("deepest chain of references: %d chunks\n"
+                % (self.depth,))
+            file.write("largest expansions (lines):\n")
+            largest = sorted(self.expansions.items(),
+                key=lambda item: (-item[1], item[0]))
+            for chunk, lines in largest[:top]:
+                file.write("%8d  %s\n" % (lines, chunk))
+
+
+IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x8, 0x80, 0x100, 0x200
+
+def _inotify(directories):
+    """Return an inotify descriptor watching directories, or None."""
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+    except (ImportError, OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    for directory in directories:
+        if isinstance(directory, unicode):
+            directory = directory.encode(sys.getfilesystemencoding())
+        if libc.inotify_add_watch(fd, directory, mask) < 0:
+            os.close(fd)
+            return None
+    return fd
+
+class Watcher(object):
+    """Keep documents in memory and redo their work whenever they change.
+
+    jobs are (input, output, options) tuples, as for process_files. cache is
+    the directory keeping highlighted chunks woven for requests, if any.
+    """
+
+    # Documents kept for requests besides the watched ones
+    max_requested = 16
+    # Seconds and bytes a client has to send its request
+    request_timeout = 1.0
+    request_size = 1 << 16
+
+    def __init__(self, jobs, interval=1.0, cache=None):
+        self.jobs = [(input, output, dict(options, lazy=False))
+            for input, output, options in jobs]
+        self.interval = interval
+        self.cache = cache
+        self.records = [{} for job in jobs]
+        self.stamps = [None for job in jobs]
+        self.documents = {}
+        self.watched = set(os.path.abspath(input)
+            for input, output, options in jobs)
+        # Requests can only name documents below this directory
+        self.root = os.path.realpath(os.curdir)
+        # Documents read for requests only, the least recently used first
+        self.requested = []
+        self.server = None
+        self.server_path = None
+        self._notify = None
+
+    def document(self, input, encoding='utf-8'):
+        """Return the document read from input, reading it again if it changed."""
+        key = (os.path.abspath(input), encoding)
+        doc = self.documents.get(key)
+        if doc is None or doc.changed():
+            doc = self.documents[key] = Reader(key[0], encoding)
+        if key[0] not in self.watched:
+            # Only the most recently requested of the others are kept
+            if key in self.requested:
+                self.requested.remove(key)
+            self.requested.append(key)
+            while len(self.requested) > self.max_requested:
+                del self.documents[self.requested.pop(0)]
+        return doc
+
+    def update(self):
+        """Bring the outputs up to date and return what was done."""
+        messages = []
+        for i, (input, output, options) in enumerate(self.jobs):
+            stamp = _file_stamp(input)
+            doc = self.documents.get((os.path.abspath(input), options['encoding']))
+            outputs = self.records[i].get('outputs', {})
+            if stamp == self.stamps[i] and (doc is None or not doc.changed()) \
+                    and all(_is_intact(path, entry)
+                        for path, entry in outputs.items()):
+                continue
+            self.stamps[i] = stamp
+            try:
+                doc = self.document(input, options['encoding'])
+                self.records[i] = update_file(input, output, self.records[i],
+                    doc=doc, **options)
+            except Exception as e:
+                messages.append("%s: %s" % (input, e))
+                continue
+            messages.extend("wrote %s" % (path,)
+                for path, entry in sorted(self.records[i]['outputs'].items())
+                if outputs.get(path, {}).get('stamp') != entry['stamp'])
+        return messages
+
+    def listen(self, path):
+        """Answer requests on a Unix socket at path."""
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.remove(path)
+        except OSError:
+            pass
+        import socket
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(5)
+        self.server_path = path
+
+    def serve(self):
+        """Answer a single request."""
+        import json
+        import socket
+        conn = self.server.accept()[0]
+        try:
+            try:
+                request = json.loads(self._receive(conn).decode('utf-8'))
+                input = os.path.abspath(request['input'])
+                if input not in self.watched and not os.path.realpath(input) \
+                        .startswith(os.path.join(self.root, '')):
+                    raise ValueError("%s is neither watched nor below %s" % (
+                        input, self.root))
+                doc = self.document(input, request.get('encoding', 'utf-8'))
+                if request.get('chunk'):
+                    data = doc.write(doc.tangle(request['chunk']))
+                else:
+                    data = doc.write(doc.weave(
+                        default_code_syntax=request.get('default_code_syntax'),
+                        add_links=request.get('add_links', False),
+                        cross_references=request.get('cross_references', False),
+                        index=request.get('index', False),
+                        format=request.get('format'),
+                        highlight=request.get('highlight'),
+                        cache=self.cache))
+                header = dict(size=len(data))
+            except Exception as e:
+                data = b''
+                header = dict(error="%s" % (e,))
+            conn.sendall(json.dumps(header).encode('utf-8') + b'\n' + data)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def _receive(self, conn):
+        """Return the line a client sends, given request_timeout seconds."""
+        deadline = timer() + self.request_timeout
+        data = b''
+        while b'\n' not in data:
+            remaining = deadline - timer()
+            if remaining <= 0 or len(data) > self.request_size:
+                raise ValueError("Request not received in time")
+            conn.settimeout(remaining)
+            received = conn.recv(4096)
+            if not received:
+                break
+            data += received
+        # The answer must not take long to send either
+        conn.settimeout(self.request_timeout)
+        return data.split(b'\n', 1)[0]
+
+    def wait(self):
+        """Wait until an input may have changed, answering any requests."""
+        waiting = [fd for fd in (self._notify, self.server) if fd is not None]
+        if not waiting:
+            time.sleep(self.interval)
+            return
+        import select
+        ready = select.select(waiting, [], [], self.interval)[0]
+        if self._notify is not None and self._notify in ready:
+            os.read(self._notify, 65536)
+        if self.server is not None and self.server in ready:
+            self.serve()
+
+    def run(self, log=sys.stderr):
+        """Update the outputs forever, reporting to log what happened."""
+        self._notify = _inotify(set(os.path.dirname(os.path.abspath(input))
+            for input, output, options in self.jobs))
+        while True:
+            for message in self.update():
+                log.write("%s\n" % (message,))
+                log.flush()
+            self.wait()
+
+    def close(self):
+        if self._notify is not None:
+            os.close(self._notify)
+            self._notify = None
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            os.remove(self.server_path)
+
+
+def request_output(path, input, chunk=None, encoding='utf-8', **kwargs):
+    """Return the bytes a watcher listening on path makes of input.
+
+    chunk is tangled if it is given and the document is woven with the
+    keyword arguments otherwise.
+    """
+    request = dict(kwargs, input=os.path.abspath(input), chunk=chunk,
+        encoding=encoding)
+    import json
+    import socket
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        conn.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        reply = conn.makefile('rb')
+        header = json.loads(reply.readline().decode('utf-8'))
+        if 'error' in header:
+            raise RuntimeError(header['error'])
+        return reply.read(header['size'])
+    finally:
+        conn.close()
+
+
+class AsyncReader(object):
+    """Reads, tangles and weaves documents in threads for asyncio."""
+
+    def __init__(self, limit=4, executor=None, encoding='utf-8',
+            lazy=False):
+        from concurrent.futures import ThreadPoolExecutor
+        self.own_executor = executor is None
+        self.executor = ThreadPoolExecutor(limit) if executor is None \
+            else executor
+        self.encoding = encoding
+        self.lazy = lazy
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __aenter__(self):
+        return self._completed(self)
+
+    def __aexit__(self, *exc_info):
+        self.close()
+        return self._completed(None)
+
+    def close(self):
+        if self.own_executor:
+            self.executor.shutdown(wait=False)
+
+    def read(self, input):
+        """Return a future of a Reader of the document input."""
+        return self._run(self._document, input)
+
+    def tangle(self, input, chunk, line_directives=None):
+        """Return a future of the bytes of chunk tangled from input."""
+        return self._run(self._output, input, None, False, chunk,
+            line_directives)
+
+    def weave(self, input, **kwargs):
+        """Return a future of the bytes of input woven with kwargs."""
+        return self._run(self._output, input, None, False, None, None,
+            kwargs)
+
+    def tangle_file(self, input, output, chunk, atomic=True,
+            line_directives=None):
+        """Return a future of tangling chunk from input to the file output."""
+        return self._run(self._output, input, output, atomic, chunk,
+            line_directives)
+
+    def weave_file(self, input, output, atomic=True, **kwargs):
+        """Return a future of weaving input to the file output."""
+        return self._run(self._output, input, output, atomic, None, None,
+            kwargs)
+
+    def _run(self, func, *args):
+        import asyncio
+        import threading
+        loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+        cancelled = threading.Event()
+        future = loop.run_in_executor(self.executor, func, cancelled, *args)
+        def done(future):
+            if future.cancelled():
+                cancelled.set()
+        future.add_done_callback(done)
+        return future
+
+    def _completed(self, result):
+        import asyncio
+        future = getattr(asyncio, 'get_running_loop',
+            asyncio.get_event_loop)().create_future()
+        future.set_result(result)
+        return future
+
+    def _document(self, cancelled, input):
+        if isinstance(input, Reader):
+            return input
+        _check_cancelled(cancelled)
+        doc = Reader(encoding=self.encoding, lazy=self.lazy)
+        doc.read(input)
+        return doc
+
+    def _output(self, cancelled, input, output, atomic, chunk,
+            line_directives, kwargs=None):
+        doc = self._document(cancelled, input)
+        if chunk:
+            lines = doc.tangled(chunk, line_directives)
+        else:
+            lines = doc.weave(**kwargs)
+        return doc.write(_until_cancelled(lines, cancelled), output, atomic)
+
+def _check_cancelled(cancelled):
+    if cancelled.is_set():
+        from concurrent.futures import CancelledError
+        raise CancelledError()
+
+def _until_cancelled(items, cancelled):
+    """Yield items until the event cancelled is set."""
+    for item in items:
+        _check_cancelled(cancelled)
+        yield item
+
+
+def build(document, outputs, encoding=None, expected=None, atomic=True):
+    """Tangle and weave a document into several outputs, reading it once.
+
+    outputs maps the path of every output to the chunk tangled into it, or to
+    a dictionary of keyword arguments for weave. expected maps paths to the
+    bytes another tangler made of them, which ours must match. The paths of
+    the outputs that changed, and so were written, are returned.
+    """
+    doc = Reader(document, encoding)
+    contents = {}
+    for path, target in outputs.items():
+        if isinstance(target, basestring):
+            contents[path] = doc.write(doc.tangle(target))
+        else:
+            contents[path] = doc.write(doc.weave(**target))
+        if expected and path in expected and expected[path] != contents[path]:
+            raise ValueError("%s: tangled differently than expected" % (path,))
+
+    written = []
+    for path in sorted(contents):
+        data = contents[path]
+        try:
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    continue
+        except IOError:
+            pass
+        _write_bytes(path, data, atomic)
+        if data.startswith(b'#!'):
+            mode = os.stat(path).st_mode
+            os.chmod(path, mode | (mode & 0o444) >> 2)
+        written.append(path)
+    return written
 
-        if file is None:
-            return outfile.getvalue()
-        elif isinstance(file, basestring):
-            with open(file, 'w') as f:
-                txt = outfile.getvalue()
-                if isinstance(txt, unicode):
-                    txt = txt.encode(self.encoding)
-                f.write(txt)
 
 def main():
+    import argparse
+
     parser = argparse.ArgumentParser('NoWeb command line options.')
-    subparsers = parser.add_subparsers(help='Working modes')
-    parser.add_argument('input', metavar='FILE',
-        help='input file to process, "-" for stdin')
+    subparsers = parser.add_subparsers(help='Working modes', dest='command')
     parser.add_argument('-o', '--output', metavar='FILE', default='-',
-        help='file to output to, "-" for stdout (default: %(default)s)')
+        help='file to output to, "-" for stdout (default: %(default)s); '
+             'a directory when several inputs are given')
     parser.add_argument('-e', '--encoding', metavar='ENCODING',
         default='utf-8',
         help='Input and output encoding (default: %(default)s)')
+    parser.add_argument('-m', '--manifest', metavar='FILE',
+        help='record what was built in this file and only redo the work that '
+             'changed since the last run')
+    parser.add_argument('--atomic', action="store_true",
+        help='write every output file under a temporary name and rename it into '
+             'place once it is complete')
+    parser.add_argument('--stats', action="store_true",
+        help='report where the time went on stderr')
+    parser.add_argument('--profile', metavar='FILE',
+        help='run under cProfile and save its statistics to FILE')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+        help='number of documents to process in parallel, 0 for one per CPU '
+             '(default: %(default)s)')
+
+    # Every working mode takes the documents to process
+    parser_inputs = argparse.ArgumentParser(add_help=False)
+    parser_inputs.add_argument('inputs', metavar='FILE', nargs='+',
+        help='input files, directories or glob patterns to process, '
+             '"-" for stdin')
 
     # Create the parser for the "tangle" command
-    parser_tangle = subparsers.add_parser('tangle', help='tangle help')
-    parser_tangle.add_argument('-R', '--chunk', metavar='CHUNK',
+    parser_tangle = subparsers.add_parser('tangle', help='tangle help',
+        parents=[parser_inputs])
+    tangle_group = parser_tangle.add_mutually_exclusive_group(required=True)
+    tangle_group.add_argument('-R', '--chunk', metavar='CHUNK',
         help='name of chunk to write to stdout')
+    tangle_group.add_argument('--all', action="store_true",
+        help='write every root chunk to a file of the same name, relative to '
+             'the directory given by --output ("-" for the current directory)')
+    parser_tangle.add_argument('--lazy', action="store_true",
+        help='memory-map the input and only parse the chunks that are tangled')
+    parser_tangle.add_argument('--line-directives', action='store_const',
+        const=Reader.LINE_DIRECTIVE,
+        help='precede lines with a C #line directive naming their line and file '
+             'in the document')
+    parser_tangle.add_argument('--line-template', metavar='TEMPLATE',
+        dest='line_directives',
+        help='like --line-directives, using this template of %%(line)d and '
+             '%%(file)s for the directives')
+    parser_tangle.add_argument('--source-map', action="store_true",
+        help='write a source map next to every output file')
+    parser_tangle.set_defaults(default_code_syntax=None, add_links=False,
+        cross_references=False, index=False, format=None, highlight=False,
+        style=None, cache=None)
 
     # Create the parser for the "weave" command
-    parser_weave = subparsers.add_parser('weave', help='weave help')
+    parser_weave = subparsers.add_parser('weave', help='weave help',
+        parents=[parser_inputs])
     parser_weave.add_argument('--default-code-syntax', metavar='LANGUAGE',
         help='use this syntax for code chunks')
     parser_weave.add_argument('--add-links', action="store_true",
         help='Add HTML links to each code chunk')
-    parser_weave.set_defaults(chunk=None)
+    parser_weave.add_argument('--cross-references', action="store_true",
+        help='follow every chunk with the chunks it uses and the chunks using it')
+    parser_weave.add_argument('--index', action="store_true",
+        help='end the document with an index of the chunks')
+    parser_weave.add_argument('--format', metavar='FORMAT',
+        help='weave to this format, such as markdown, html or latex (default: '
+             'the syntax of the document)')
+    parser_weave.add_argument('--highlight', action="store_true",
+        help='highlight the code of HTML documents with Pygments, if installed')
+    parser_weave.add_argument('--style', metavar='STYLE', default='default',
+        help='Pygments style to highlight in (default: %(default)s)')
+    parser_weave.add_argument('--cache', metavar='DIR',
+        help='keep highlighted chunks in DIR to reuse them when weaving again')
+    parser_weave.set_defaults(chunk=None, all=False, lazy=False,
+        line_directives=None, source_map=False)
+
+    # Create the parser for the "watch" command
+    parser_watch = subparsers.add_parser('watch',
+        help='keep tangling or weaving the inputs whenever they change',
+        parents=[parser_inputs])
+    watch_group = parser_watch.add_mutually_exclusive_group()
+    watch_group.add_argument('-R', '--chunk', metavar='CHUNK',
+        help='name of chunk to tangle; the documents are woven when neither '
+             'this nor --all is given')
+    watch_group.add_argument('--all', action="store_true",
+        help='tangle every root chunk, like "tangle --all"')
+    parser_watch.add_argument('--default-code-syntax', metavar='LANGUAGE',
+        help='use this syntax for code chunks when weaving')
+    parser_watch.add_argument('--add-links', action="store_true",
+        help='Add HTML links to each code chunk when weaving')
+    parser_watch.add_argument('--cross-references', action="store_true",
+        help='follow every woven chunk with the chunks it uses and the chunks '
+             'using it')
+    parser_watch.add_argument('--index', action="store_true",
+        help='end woven documents with an index of the chunks')
+    parser_watch.add_argument('--format', metavar='FORMAT',
+        help='format to weave to (default: the syntax of the document)')
+    parser_watch.add_argument('--highlight', action="store_true",
+        help='highlight the code of HTML documents when weaving')
+    parser_watch.add_argument('--style', metavar='STYLE', default='default',
+        help='Pygments style to highlight in (default: %(default)s)')
+    parser_watch.add_argument('--cache', metavar='DIR',
+        help='keep highlighted chunks in DIR to reuse them when weaving again')
+    parser_watch.add_argument('--interval', metavar='SECONDS', type=float,
+        default=1.0,
+        help='how often to look for changes when inotify is not available '
+             '(default: %(default)s)')
+    parser_watch.add_argument('--socket', metavar='PATH',
+        help='also answer tangle and weave requests on this Unix socket')
+    parser_watch.set_defaults(lazy=False, line_directives=None,
+        source_map=False)
+
+    # Create the parser for the "deps" command
+    parser_deps = subparsers.add_parser('deps',
+        help='write down the chunks every output depends on',
+        parents=[parser_inputs])
+    parser_deps.add_argument('-R', '--chunk', metavar='CHUNK',
+        help='only describe this chunk instead of every root chunk')
+    parser_deps.add_argument('--directory', metavar='DIR', default=os.curdir,
+        help='directory the root chunks are tangled to (default: %(default)s)')
+    parser_deps.add_argument('--format', choices=['make', 'ninja', 'json'],
+        default='make', help='format to write in (default: %(default)s)')
+    parser_deps.set_defaults(source_map=False)
+
+    # Create the parser for the "check" command
+    parser_check = subparsers.add_parser('check',
+        help='report undefined, unused, duplicate and cyclic chunks',
+        parents=[parser_inputs])
+    parser_check.add_argument('-R', '--chunk', metavar='CHUNK', action='append',
+        default=[],
+        help='root chunk not to report as unused, when it is not named like a '
+             'file; can be given several times')
+    parser_check.set_defaults(source_map=False, format=None)
     args = parser.parse_args()
-    input = args.input
-    if args.input == '-':
-        input = sys.stdin
-    doc = Reader(encoding=args.encoding)
-    doc.read(input)
-    out = args.output
-    if out == '-':
-        out = sys.stdout
-
-    # If args.chunk is None -> Weaver mode
-    if args.chunk:
-        lines = doc.tangle(args.chunk)
+    inputs = expand_inputs(args.inputs)
+    if '-' in inputs and len(inputs) > 1:
+        parser.error('"-" can only be used as the only input')
+    if args.command == 'watch' and ('-' in inputs or
+            (args.output == '-' and not args.all and len(inputs) == 1)):
+        parser.error('watch needs input files and an output file or directory')
+    if args.jobs < 0:
+        parser.error('--jobs must be 0 or more')
+    if args.profile and args.jobs != 1:
+        parser.error('--profile only profiles a single process, use -j 1')
+    if args.source_map and args.output == '-' and not args.all \
+            and len(inputs) == 1:
+        parser.error('--source-map needs an output file')
+    if args.command != 'deps' and args.format is not None:
+        try:
+            find_formatter(args.format)
+        except ValueError as e:
+            parser.error("%s" % (e,))
+    if args.command in ('weave', 'watch'):
+        # Requests to a watcher may ask for highlighting it doesn't do itself
+        if args.cache and not args.highlight and not getattr(args, 'socket', None):
+            parser.error('--cache only keeps highlighted chunks, use --highlight')
+        if args.highlight and (args.format is None
+                or not issubclass(find_formatter(args.format), HtmlFormatter)):
+            parser.error('--highlight only highlights HTML, use --format html')
+    if args.command in ('weave', 'watch') and args.highlight:
+        try:
+            from pygments.styles import get_style_by_name
+        except ImportError:
+            get_style_by_name = None
+        try:
+            if get_style_by_name is not None:
+                get_style_by_name(args.style)
+        except ValueError as e:
+            parser.error("%s" % (e,))
+    stats = profiler = None
+    if args.stats:
+        stats = Stats()
+        Reader.global_hooks.append(stats)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        _main(args, inputs, stats)
+    except (DocumentError, IOError, OSError) as e:
+        sys.exit("%s" % (e,))
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if stats is not None:
+            Reader.global_hooks.remove(stats)
+            stats.report(sys.stderr)
+
+def _main(args, inputs, stats=None):
+    if args.command == 'check':
+        problems = []
+        for input in inputs:
+            try:
+                doc = Reader(encoding=args.encoding)
+                doc.read(getattr(sys.stdin, 'buffer', sys.stdin)
+                    if input == '-' else input)
+                problems.extend(doc.check(args.chunk))
+            except (IOError, OSError, ValueError) as e:
+                problems.append("%s: %s" % (input, e))
+        for problem in problems:
+            sys.stderr.write("%s\n" % (problem,))
+        if problems:
+            sys.exit(1)
+        return
+
+    if args.command == 'deps':
+        outputs = {}
+        for input in inputs:
+            doc = Reader(encoding=args.encoding)
+            doc.read(getattr(sys.stdin, 'buffer', sys.stdin) if input == '-'
+                else input)
+            outputs.update(document_dependencies(doc, input, args.directory,
+                args.chunk))
+        text = format_dependencies(outputs, args.format).encode('utf-8')
+        if args.output == '-':
+            getattr(sys.stdout, 'buffer', sys.stdout).write(text)
+        else:
+            with open(args.output, 'wb') as f:
+                f.write(text)
+        return
+
+    options = dict(encoding=args.encoding, chunk=args.chunk,
+        tangle_all=args.all, default_code_syntax=args.default_code_syntax,
+        add_links=args.add_links, cross_references=args.cross_references,
+        index=args.index, format=args.format,
+        highlight=args.style if args.highlight else None, cache=args.cache,
+        lazy=args.lazy, atomic=args.atomic,
+        line_directives=args.line_directives, source_map=args.source_map)
+    if len(inputs) == 1:
+        jobs = [(inputs[0], args.output, options)]
     else:
-        lines = doc.weave(default_code_syntax=args.default_code_syntax,
-            add_links=args.add_links)
-    doc.write(lines, out)
+        outdir = os.curdir if args.output == '-' else args.output
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        jobs = []
+        for input in inputs:
+            output = outdir
+            if not args.all:
+                output = os.path.join(outdir, os.path.basename(input))
+                if output.endswith('.nw'):
+                    output = output[:-len('.nw')]
+                if not args.chunk:
+                    output += find_formatter(args.format).extension \
+                        if args.format else '.md'
+            jobs.append((input, output, options))
+        if not args.all:
+            written = {}
+            for input, output, options in jobs:
+                if output in written:
+                    sys.exit("%s and %s would both be written to %s" % (
+                        written[output], input, output))
+                written[output] = input
+
+    if args.command == 'watch':
+        watcher = Watcher(jobs, args.interval, args.cache)
+        try:
+            if args.socket:
+                watcher.listen(args.socket)
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+        return
+
+    manifest = None
+    if args.manifest:
+        manifest = load_manifest(args.manifest)
+    if len(inputs) == 1:
+        input, output, options = jobs[0]
+        if manifest is None:
+            process_file(input, output, **options)
+        else:
+            documents = manifest['documents']
+            documents[input] = update_file(input, output,
+                documents.get(input, {}), **options)
+            save_manifest(args.manifest, manifest)
+        return
+
+    errors = process_files(jobs, args.jobs or None, manifest, stats)
+    if manifest is not None:
+        save_manifest(args.manifest, manifest)
+    for error in errors:
+        sys.stderr.write("%s\n" % (error,))
+    if errors:
+        sys.exit(1)
 
 if __name__ == "__main__":
-    # Delete the pure-Python version of noweb to prevent cache retrieval
-    sys.modules.pop('noweb', None)
+    import __main__ as noweb
+    if os.environ.get('NOWEB_SELF_LOAD'):
+        # Delete the pure-Python version of noweb to prevent cache retrieval
+        sys.modules.pop('noweb', None)
 
-    # Use noweb's loader to load itself
-    try:
-        noweb = ImportHook().load_module('noweb')
-    except:
-        import __main__ as noweb
+        # Use noweb's loader to load itself
+        try:
+            noweb = ImportHook().load_module('noweb')
+        except ImportError:
+            pass
 
-    # Exceptions from within noweb should now be linked to the .nw source-file
+    # Exceptions from within noweb are linked to the .nw source-file when it
+    # loaded itself
     noweb.main()
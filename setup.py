@@ -3,40 +3,16 @@
 
 from setuptools import setup, find_packages
 from distutils.command.build import build
-import tempfile
 import bootstrap
-import shutil
-import os
 
 
 
 class CustomBuild(build):
     def run(self):
-        tmpdir = None
-        try:
-            # Create a temporary working directory
-            tmpdir = tempfile.mkdtemp()
-
-            # Create tmp script
-            tmp_noweb = os.path.join(tmpdir, "noweb.py")
-
-            # Tangle
-            chunks = bootstrap.read("noweb.py.nw", "utf-8")
-            lines = bootstrap.tangle("noweb.py", chunks, "")
-            bootstrap.write(lines, "noweb.py", tmp_noweb, "utf-8")
-
-            # And tangle again
-            tangle_spell = "python " + tmp_noweb + " -o noweb.py tangle -R noweb.py noweb.py.nw"
-            os.system(tangle_spell)
-
-            # Weave
-            os.system("python noweb.py -o README.md weave --default-code-syntax=python noweb.py.nw")
-
-        finally:
-            # Clean up our temporary working directory
-            if tmpdir:
-                shutil.rmtree(tmpdir, ignore_errors=True)
-            build.run(self)
+        # Tangle noweb.py, check that it tangles itself the same way and weave
+        # README.md, all in this process
+        bootstrap.build("noweb.py.nw", "noweb.py", "README.md", "utf-8")
+        build.run(self)
 
 
 
@@ -49,7 +25,8 @@ if __name__ == '__main__':
         author='Javier Escalada Gómez',
         author_email='kerrigan29a@gmail.com',
         url='http://github.com/Kerrigan29a/noweb.py',
-        packages=find_packages(),
+        # The benchmarks are run from a checkout, not installed
+        packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
         include_package_data=True,
         install_requires=[
         ],